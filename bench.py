@@ -0,0 +1,296 @@
+# میکروبنچمارک‌ها و بررسی‌های ربات؛ اجرا: python bench.py {wizard,search,plans,logging}
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ.setdefault("WEBHOOK_URL", "https://example.invalid/webhook")
+os.environ.setdefault("FSM_PERSIST", "0")
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+os.chdir(tempfile.mkdtemp(prefix="bolori_bench_"))
+
+import main  # noqa: E402
+
+
+# پیام ساختگی که فقط پاسخ‌ها را می‌شمارد
+class FakeMessage:
+    def __init__(self, text=None, photo=None, contact=None):
+        self.text = text
+        self.photo = photo
+        self.contact = contact
+        self.caption = None
+
+    async def reply_text(self, text, **kwargs):
+        return None
+
+
+def fake_update(user_id, **message_fields):
+    user = SimpleNamespace(id=user_id, username="bench", first_name="bench")
+    message = FakeMessage(**message_fields)
+    return SimpleNamespace(effective_user=user, effective_message=message, message=message, callback_query=None)
+
+
+# پیام‌های یک ثبت آگهی کامل تا قبل از /done
+def wizard_messages():
+    photo = [SimpleNamespace(file_id="photo")]
+    return [
+        ("post_ad", {"text": "پژو 207"}),
+        ("post_ad", {"text": "سفید، بدون رنگ"}),
+        ("post_ad", {"text": "abc"}),
+        ("post_ad", {"text": "850000000"}),
+        ("post_ad", {"text": "0915 363 2957"}),
+    ] + [("post_ad", {"photo": photo})] * 5 + [
+        ("post_referral", {"text": "حواله پژو"}),
+        ("post_referral", {"text": "تحویل فوری"}),
+        ("post_referral", {"text": "1000000"}),
+    ]
+
+
+async def bench_wizard(rounds):
+    context = SimpleNamespace(bot=None)
+    messages = wizard_messages()
+    handled = 0
+    elapsed = 0.0
+    for i in range(rounds):
+        user_id = 1000 + i
+        for kind, fields in messages:
+            if kind == "post_ad" and fields.get("text") == "پژو 207":
+                await main.post_ad_start(fake_update(user_id), context)
+            elif kind == "post_referral" and fields.get("text") == "حواله پژو":
+                await main.post_referral_start(fake_update(user_id), context)
+            update = fake_update(user_id, **fields)
+            started = time.perf_counter()
+            await main.message_dispatcher(update, context)
+            elapsed += time.perf_counter() - started
+            handled += 1
+        await main.FSM_STORE.clear(user_id)
+    print(f"wizard: {handled} messages, {elapsed / handled * 1e6:.1f} us/message")
+
+
+def run_wizard(args):
+    main.logger.setLevel("WARNING")
+    main.init_db()
+    asyncio.run(bench_wizard(args.rounds))
+
+
+# ساخت آگهی‌های مصنوعی برای بنچمارک جست‌وجو
+BRANDS = ["پژو 207", "پژو 405", "پژو پارس", "سمند", "دنا", "تیبا", "ساینا", "کوییک", "شاهین", "رانا",
+          "هایما", "جک", "چری تیگو", "ام وی ام", "تویوتا کمری", "هیوندای سوناتا", "کیا اسپورتیج", "بنز", "ب ام و", "رنو"]
+COLORS = ["سفید", "مشکی", "نقره‌ای", "خاکستری", "آبی", "قرمز", "سبز"]
+WORDS = ["بدون رنگ", "دو لکه", "تمیز", "فنی سالم", "بیمه کامل", "لاستیک نو", "تک برگ", "صفر", "کارکرد",
+         "گیربکس سالم", "موتور تازه تعمیر", "شیشه‌ای", "فول", "اتومات", "دنده‌ای", "سند آزاد", "قسطی"]
+
+
+def fake_ad_rows(count, seed=7):
+    rng = random.Random(seed)
+    for i in range(count):
+        title = f"فروش {rng.choice(BRANDS)} مدل {rng.randint(1385, 1403)}"
+        description = (
+            f"رنگ {rng.choice(COLORS)}، کارکرد {rng.randint(0, 400)} هزار، "
+            + "، ".join(rng.sample(WORDS, 4))
+        )
+        yield (
+            i % 5000, rng.choice(("ad", "ad", "ad", "referral")), title, description,
+            rng.randint(100, 5000) * 1_000_000, f"2024-{1 + i % 12:02d}-{1 + i % 28:02d}T00:00:{i % 60:02d}",
+            "approved" if i % 10 else "pending", None, "09150000000",
+        )
+
+
+def populate_ads(count):
+    def op(conn):
+        with conn:
+            conn.executemany(
+                "INSERT INTO ads (user_id, type, title, description, price, created_at, status, image_id, phone)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                fake_ad_rows(count)
+            )
+    started = time.perf_counter()
+    main.DB.run_sync(op)
+    return time.perf_counter() - started
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+async def bench_search(queries, repeats, pages):
+    for text in queries:
+        for page in range(pages):
+            samples = []
+            for _ in range(repeats):
+                cursor = None
+                for _ in range(page):
+                    rows, _, floor = await main.search_ads(text, cursor)
+                    cursor = (rows[-1]['rank'], rows[-1]['id'], floor) if rows else None
+                started = time.perf_counter()
+                rows, _, _ = await main.search_ads(text, cursor)
+                samples.append(time.perf_counter() - started)
+            print(f"search {text!r} page {page + 1}: {len(rows)} rows, "
+                  f"p50 {statistics.median(samples) * 1e3:.2f} ms, p95 {percentile(samples, 0.95) * 1e3:.2f} ms")
+
+
+def run_search(args):
+    main.logger.setLevel("WARNING")
+    main.init_db()
+    elapsed = populate_ads(args.ads)
+    print(f"search: inserted {args.ads} ads (with FTS triggers) in {elapsed:.2f} s")
+    queries = args.query or ["پژو", "پژو 207 سفید", "تویوتا کمری", "تمیز فنی سالم", "بنز مشکی 1400", "قسطي"]
+    asyncio.run(bench_search(queries, args.repeats, args.pages))
+
+
+# بررسی طرح اجرای همه ترکیب‌های فیلتر؛ هیچ‌کدام نباید کل جدول ads را پیمایش یا نتیجه را جداگانه مرتب کند
+def run_plans(args):
+    main.logger.setLevel("WARNING")
+    main.init_db()
+    if args.ads:
+        populate_ads(args.ads)
+    if args.analyze:
+        main.DB.run_sync(lambda conn: conn.execute("ANALYZE"))
+    failures = 0
+    checked = 0
+    for ad_type, _ in main.FILTER_TYPES:
+        for min_price, max_price, _ in main.FILTER_PRICES:
+            for days, _ in main.FILTER_AGES:
+                created_after = "2024-06-01T00:00:00" if days else None
+                for cursor, direction in ((None, "n"), (("2024-07-01", 500), "n"), (("2024-07-01", 500), "p")):
+                    sql, params = main.build_filter_query(
+                        ad_type, min_price, max_price, created_after, cursor, direction
+                    )
+                    plan = main.DB.run_sync(lambda conn: conn.execute(f"EXPLAIN QUERY PLAN {sql}", params).fetchall())
+                    details = [row[3] for row in plan]
+                    checked += 1
+                    if any(detail.startswith("SCAN") or "TEMP B-TREE" in detail for detail in details):
+                        failures += 1
+                        print(f"FULL SCAN OR SORT: type={ad_type} price=({min_price}, {max_price}) "
+                              f"after={created_after} cursor={cursor} {direction}: {details}")
+                    elif args.verbose:
+                        print(f"type={ad_type} price=({min_price}, {max_price}) after={created_after} "
+                              f"cursor={cursor} {direction}: {details}")
+    print(f"plans: {checked} filter combinations checked, {failures} with a full scan or a temp b-tree sort")
+    if failures:
+        sys.exit(1)
+
+
+# لاگ‌های یک آپدیت با پیکربندی قدیمی: f-string، هدرها و بدنه webhook، DEBUG برای همه
+BENCH_UPDATE = {
+    "update_id": 123456789,
+    "message": {
+        "message_id": 4321, "date": 1700000000, "text": "پژو 207 مدل 1398 سفید بدون رنگ",
+        "chat": {"id": 987654321, "type": "private", "first_name": "کاربر", "username": "bench_user"},
+        "from": {"id": 987654321, "is_bot": False, "first_name": "کاربر", "username": "bench_user",
+                 "language_code": "fa"},
+    },
+}
+BENCH_HEADERS = {
+    "Host": "bolori.example", "User-Agent": "TelegramBot (like TwitterBot)", "Content-Type": "application/json",
+    "Content-Length": "412", "X-Forwarded-For": "91.108.6.1", "X-Telegram-Bot-Api-Secret-Token": "secret-token",
+}
+
+
+def old_update_logs(log, http_log, json_data, body):
+    log.debug("Received webhook request")
+    log.debug(f"Request headers: {BENCH_HEADERS}")
+    log.debug(f"Request body: {body}")
+    log.debug(f"Queue size after putting update: {3}")
+    log.info(f"Webhook update queued in {0.0002:.2f} seconds")
+    log.debug(f"Worker {2} processing update: {json_data}")
+    log.debug(f"Message dispatcher for user {987654321}: {json_data['message']['text']}")
+    log.debug(f"User {987654321} is in state {'post_ad_title'}")
+    http_log.info(f'HTTP Request: POST https://api.telegram.org/bot{main.BOT_TOKEN}/sendMessage "HTTP/1.1 200 OK"')
+    log.info(f"Processed update in {0.0123:.2f} seconds (waited {0.0004:.2f} seconds in queue)")
+
+
+def new_update_logs(log, http_log, json_data, body):
+    log.debug("Received webhook request")
+    log.info("Webhook update %s queued in %.4f seconds", 123456789, 0.0002, extra=main.LOG_SAMPLED)
+    log.debug("Worker %s processing update: %s", 2, json_data, extra=main.LOG_SAMPLED)
+    log.debug("Message dispatcher for user %s: %s", 987654321, json_data['message']['text'])
+    log.debug("User %s is in state %s", 987654321, "post_ad_title")
+    http_log.info('HTTP Request: %s %s "%s"', "POST", f"https://api.telegram.org/bot{main.BOT_TOKEN}/sendMessage",
+                  "HTTP/1.1 200 OK")
+    log.info("Processed update in %.2f seconds (waited %.2f seconds in queue)", 0.0123, 0.0004, extra=main.LOG_SAMPLED)
+
+
+def configure_old_logging(path, devnull):
+    main.stop_logging()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    formatter = logging.Formatter(main.LOG_FORMAT)
+    for handler in (logging.FileHandler(path), logging.StreamHandler(devnull)):
+        handler.setFormatter(formatter)
+        root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+    for name in ("telegram", "httpx", "httpcore"):
+        logging.getLogger(name).setLevel(logging.DEBUG)
+    return None
+
+
+def run_logging(args):
+    json_data = BENCH_UPDATE
+    body = json.dumps(json_data, ensure_ascii=False)
+    log = logging.getLogger("main")
+    http_log = logging.getLogger("httpx")
+    with open(os.devnull, "w") as devnull:
+        setups = [
+            ("sync FileHandler, DEBUG (old)", old_update_logs, lambda path: configure_old_logging(path, devnull)),
+            ("queue, DEBUG", new_update_logs,
+             lambda path: main.configure_logging("DEBUG", "", path, 1, devnull)),
+            ("queue, DEBUG sampled 10%", new_update_logs,
+             lambda path: main.configure_logging("DEBUG", "", path, 0.1, devnull)),
+            ("queue, INFO (default)", new_update_logs,
+             lambda path: main.configure_logging(main.LOG_LEVEL, main.LOG_LEVELS, path, 1, devnull)),
+            ("queue, INFO sampled 10%", new_update_logs,
+             lambda path: main.configure_logging(main.LOG_LEVEL, main.LOG_LEVELS, path, 0.1, devnull)),
+        ]
+        for index, (name, emit, configure) in enumerate(setups):
+            path = f"bench_{index}.log"
+            queue_handler = configure(path)
+            started = time.perf_counter()
+            for _ in range(args.updates):
+                emit(log, http_log, json_data, body)
+            caller = time.perf_counter() - started
+            main.stop_logging()
+            total = time.perf_counter() - started
+            size = os.path.getsize(path) / args.updates
+            dropped = queue_handler.dropped if queue_handler else 0
+            print(f"logging {name:<28} {caller / args.updates * 1e6:6.1f} us/update on the event loop, "
+                  f"{total / args.updates * 1e6:6.1f} us/update until written, {size:5.0f} bytes/update, "
+                  f"{dropped} dropped")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Bolori bot micro-benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    wizard = commands.add_parser("wizard", help="per-message cost of the ad/referral wizard")
+    wizard.add_argument("--rounds", type=int, default=2000)
+    wizard.set_defaults(func=run_wizard)
+    search = commands.add_parser("search", help="FTS5 search latency over a synthetic ads table")
+    search.add_argument("--ads", type=int, default=100_000)
+    search.add_argument("--repeats", type=int, default=20)
+    search.add_argument("--pages", type=int, default=2)
+    search.add_argument("--query", action="append")
+    search.set_defaults(func=run_search)
+    plans = commands.add_parser("plans", help="assert that no listing filter combination scans or sorts the ads table")
+    plans.add_argument("--ads", type=int, default=0, help="populate synthetic ads first")
+    plans.add_argument("--analyze", action="store_true", help="run ANALYZE before checking")
+    plans.add_argument("--verbose", action="store_true")
+    plans.set_defaults(func=run_plans)
+    log = commands.add_parser("logging", help="per-update logging overhead, old synchronous setup vs queue pipeline")
+    log.add_argument("--updates", type=int, default=20_000)
+    log.set_defaults(func=run_logging)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,336 @@
+# سرور جایگزین Bot API تلگرام برای تست و بنچمارک آفلاین ربات
+# اجرا: python fake_telegram.py --port 8081 --latency-ms 50 --rate-429 0.01
+# و در ربات: TELEGRAM_API_BASE_URL=http://127.0.0.1:8081
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import deque
+
+from aiohttp import ClientSession, web
+
+logger = logging.getLogger("fake_telegram")
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "Bolori Test Bot", "username": "bolori_test_bot",
+            "can_join_groups": True, "can_read_all_group_messages": False, "supports_inline_queries": True}
+SEND_METHODS = ("sendMessage", "sendPhoto", "sendMediaGroup", "sendDocument")
+RECORDED_CALLS = 200  # تعداد آخرین فراخوانی‌های نگه‌داشته‌شده برای هر متد
+MEMBER_STATUSES = ("member", "left", "kicked", "creator")
+MEMBER_STATUS_FIELDS = {"kicked": {"until_date": 0}, "creator": {"is_anonymous": False}}
+
+
+class Config:
+    def __init__(self, args):
+        self.latency_ms = args.latency_ms
+        self.jitter_ms = args.jitter_ms
+        self.method_latency_ms = dict(args.method_latency or ())
+        self.rate_429 = args.rate_429
+        self.retry_after = args.retry_after
+        self.rate_403 = args.rate_403
+        self.enforce_limits = args.enforce_limits
+        self.member_status = args.member_status
+
+    def update(self, values):
+        for key, value in values.items():
+            if not hasattr(self, key):
+                raise KeyError(key)
+            setattr(self, key, value)
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+# محدودیت‌های واقعی تلگرام: حدود ۳۰ پیام در ثانیه در کل و ۱ پیام در ثانیه برای هر چت
+class FloodLimits:
+    GLOBAL_PER_SECOND = 30
+    CHAT_PER_SECOND = 1
+    CHAT_BURST = 3
+    GROUP_PER_MINUTE = 20
+
+    def __init__(self):
+        self._global = deque()
+        self._chats = {}
+
+    def check(self, chat_id):
+        now = time.monotonic()
+        while self._global and now - self._global[0] >= 1:
+            self._global.popleft()
+        if len(self._global) >= self.GLOBAL_PER_SECOND:
+            return 1
+        sent = self._chats.setdefault(chat_id, deque())
+        group = isinstance(chat_id, str) or (isinstance(chat_id, int) and chat_id < 0)
+        if group:
+            window, limit = 60, self.GROUP_PER_MINUTE
+        else:
+            window, limit = self.CHAT_BURST / self.CHAT_PER_SECOND, self.CHAT_BURST
+        while sent and now - sent[0] >= window:
+            sent.popleft()
+        if len(sent) >= limit:
+            return max(1, int(window - (now - sent[0])) + 1)
+        self._global.append(now)
+        sent.append(now)
+        return 0
+
+
+class FakeTelegram:
+    def __init__(self, config):
+        self.config = config
+        self.limits = FloodLimits()
+        self.counts = {}
+        self.errors = {}
+        self.calls = {}
+        self.webhook = {"url": "", "secret_token": None}
+        self.members = {}
+        self._message_id = 0
+        self._file_id = 0
+
+    def next_message_id(self):
+        self._message_id += 1
+        return self._message_id
+
+    def next_file_id(self, prefix):
+        self._file_id += 1
+        return f"{prefix}{self._file_id:08d}"
+
+    def record(self, method, params):
+        self.counts[method] = self.counts.get(method, 0) + 1
+        calls = self.calls.setdefault(method, deque(maxlen=RECORDED_CALLS))
+        calls.append({"at": round(time.time(), 3), "params": params})
+
+    def reset(self):
+        self.counts.clear()
+        self.errors.clear()
+        self.calls.clear()
+        self.limits = FloodLimits()
+
+    def message(self, chat_id, **fields):
+        chat_type = "private" if isinstance(chat_id, int) and chat_id > 0 else "channel"
+        chat = {"id": chat_id, "type": chat_type} if isinstance(chat_id, int) else \
+            {"id": -1000000000001, "type": "channel", "username": str(chat_id).lstrip("@")}
+        return {"message_id": self.next_message_id(), "date": int(time.time()), "chat": chat, "from": BOT_USER,
+                **fields}
+
+    def photo(self, file_id):
+        if not isinstance(file_id, str) or file_id.startswith("attach://") or not file_id:
+            file_id = self.next_file_id("AgFAKEPHOTO")
+        return [{"file_id": file_id, "file_unique_id": file_id[-12:], "width": 1280, "height": 960,
+                 "file_size": 120000}]
+
+    # خطاهای تزریقی؛ None یعنی درخواست عادی پاسخ داده شود
+    def injected_error(self, method, params):
+        if method.startswith(("send", "edit", "copy", "forward")):
+            if self.config.rate_429 and random.random() < self.config.rate_429:
+                return 429, f"Too Many Requests: retry after {self.config.retry_after}", self.config.retry_after
+            if self.config.enforce_limits:
+                retry_after = self.limits.check(params.get("chat_id"))
+                if retry_after:
+                    return 429, f"Too Many Requests: retry after {retry_after}", retry_after
+        if method in SEND_METHODS and self.config.rate_403 and random.random() < self.config.rate_403:
+            return 403, "Forbidden: bot was blocked by the user", None
+        return None
+
+    def handle(self, method, params):
+        chat_id = params.get("chat_id")
+        if method == "getMe":
+            return BOT_USER
+        if method == "getWebhookInfo":
+            return {"url": self.webhook["url"], "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "setWebhook":
+            self.webhook = {"url": params.get("url", ""), "secret_token": params.get("secret_token")}
+            return True
+        if method == "deleteWebhook":
+            self.webhook = {"url": "", "secret_token": None}
+            return True
+        if method == "sendMessage":
+            return self.message(chat_id, text=str(params.get("text", "")))
+        if method == "sendPhoto":
+            return self.message(chat_id, photo=self.photo(params.get("photo")),
+                                caption=str(params.get("caption") or "") or None)
+        if method == "sendDocument":
+            file_id = self.next_file_id("BQFAKEDOC")
+            return self.message(chat_id, document={"file_id": file_id, "file_unique_id": file_id[-12:],
+                                                   "file_name": params.get("_filename") or "document"})
+        if method == "sendMediaGroup":
+            media_group_id = str(self.next_message_id())
+            return [
+                self.message(chat_id, media_group_id=media_group_id, photo=self.photo(item.get("media")),
+                             caption=item.get("caption"))
+                for item in params.get("media") or ()
+            ]
+        if method == "getChatMember":
+            user_id = params.get("user_id")
+            status = self.members.get(str(user_id), self.config.member_status)
+            return {"status": status, "user": {"id": user_id, "is_bot": False, "first_name": "User"},
+                    **MEMBER_STATUS_FIELDS.get(status, {})}
+        if method in ("editMessageText", "editMessageCaption", "editMessageReplyMarkup"):
+            if params.get("inline_message_id"):
+                return True
+            return self.message(chat_id, text=str(params.get("text", "")), edit_date=int(time.time()))
+        if method in ("answerCallbackQuery", "answerInlineQuery", "deleteMessage"):
+            return True
+        return None
+
+
+# خواندن پارامترها: فیلدهای غیر رشته‌ای به صورت JSON فرستاده می‌شوند
+async def read_params(request):
+    if request.content_type == "application/json":
+        return await request.json()
+    params = {}
+    form = await request.post()
+    for key, value in form.items():
+        if hasattr(value, "file"):
+            params[key] = f"<file {value.filename}>"
+            params["_filename"] = value.filename
+            continue
+        try:
+            params[key] = json.loads(value)
+        except ValueError:
+            params[key] = value
+    return params
+
+
+def api_response(result=None, status=200, description=None, retry_after=None):
+    body = {"ok": status == 200}
+    if status == 200:
+        body["result"] = result
+    else:
+        body.update(error_code=status, description=description)
+        if retry_after is not None:
+            body["parameters"] = {"retry_after": retry_after}
+    return web.json_response(body, status=status)
+
+
+async def api_handler(request):
+    server = request.app["fake"]
+    method = request.match_info["method"]
+    params = await read_params(request)
+    server.record(method, params)
+    config = server.config
+    delay = config.method_latency_ms.get(method, config.latency_ms) + random.uniform(0, config.jitter_ms)
+    if delay > 0:
+        await asyncio.sleep(delay / 1000)
+    error = server.injected_error(method, params)
+    if error:
+        status, description, retry_after = error
+        server.errors[f"{method}:{status}"] = server.errors.get(f"{method}:{status}", 0) + 1
+        return api_response(status=status, description=description, retry_after=retry_after)
+    result = server.handle(method, params)
+    if result is None:
+        return api_response(status=404, description="Not Found: method not supported by fake server")
+    return api_response(result)
+
+
+# مسیرهای کنترلی: آمار و فراخوانی‌های ثبت‌شده، تنظیم در زمان اجرا، ارسال آپدیت به webhook ربات
+async def calls_handler(request):
+    server = request.app["fake"]
+    method = request.query.get("method")
+    calls = {name: list(items) for name, items in server.calls.items() if not method or name == method}
+    return web.json_response({"counts": server.counts, "errors": server.errors, "calls": calls})
+
+
+async def reset_handler(request):
+    request.app["fake"].reset()
+    return web.json_response({"ok": True})
+
+
+async def config_handler(request):
+    server = request.app["fake"]
+    if request.method == "POST":
+        values = await request.json()
+        members = values.pop("members", None)
+        try:
+            server.config.update(values)
+        except KeyError as e:
+            return web.json_response({"ok": False, "description": f"unknown setting {e}"}, status=400)
+        if members is not None:
+            server.members.update({str(user_id): status for user_id, status in members.items()})
+    return web.json_response({**server.config.as_dict(), "members": server.members, "webhook": server.webhook})
+
+
+def synthetic_update(update_id, user_id, text):
+    user = {"id": user_id, "is_bot": False, "first_name": f"User {user_id}", "username": f"user{user_id}"}
+    message = {"message_id": update_id, "date": int(time.time()), "chat": {**user, "type": "private"},
+               "from": user, "text": text}
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+# ارسال آپدیت‌ها به webhook ثبت‌شده؛ بدنه: {"updates": [...]} یا {"count": n, "users": m, "text": "/start"}
+async def push_handler(request):
+    server = request.app["fake"]
+    if not server.webhook["url"]:
+        return web.json_response({"ok": False, "description": "no webhook set"}, status=409)
+    body = await request.json()
+    updates = body.get("updates")
+    if updates is None:
+        first = int(body.get("first_update_id", int(time.time() * 1000) % 10 ** 9))
+        users = max(1, int(body.get("users", 1)))
+        updates = [
+            synthetic_update(first + i, 1000 + i % users, body.get("text", "/start"))
+            for i in range(int(body.get("count", 1)))
+        ]
+    headers = {"X-Telegram-Bot-Api-Secret-Token": server.webhook["secret_token"]} \
+        if server.webhook["secret_token"] else {}
+    concurrency = asyncio.Semaphore(int(body.get("concurrency", 20)))
+    statuses = {}
+    started = time.perf_counter()
+
+    async def deliver(session, update):
+        async with concurrency:
+            async with session.post(server.webhook["url"], json=update, headers=headers) as response:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    async with ClientSession() as session:
+        await asyncio.gather(*(deliver(session, update) for update in updates))
+    return web.json_response({"ok": True, "delivered": len(updates), "statuses": statuses,
+                              "seconds": round(time.perf_counter() - started, 3)})
+
+
+def build_app(config):
+    app = web.Application()
+    app["fake"] = FakeTelegram(config)
+    app.router.add_post("/bot{token}/{method}", api_handler)
+    app.router.add_get("/bot{token}/{method}", api_handler)
+    app.router.add_get("/_calls", calls_handler)
+    app.router.add_post("/_reset", reset_handler)
+    app.router.add_get("/_config", config_handler)
+    app.router.add_post("/_config", config_handler)
+    app.router.add_post("/_push", push_handler)
+    return app
+
+
+def method_latency(value):
+    method, _, milliseconds = value.partition("=")
+    return method, float(milliseconds)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fake Telegram Bot API server for offline testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=0, help="base latency of every API call")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="uniform random extra latency")
+    parser.add_argument("--method-latency", type=method_latency, action="append", metavar="METHOD=MS",
+                        help="per-method latency override, e.g. getChatMember=200")
+    parser.add_argument("--rate-429", type=float, default=0, help="share of send/edit calls answered with 429")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after of injected 429 errors")
+    parser.add_argument("--rate-403", type=float, default=0, help="share of send calls answered with 403 blocked")
+    parser.add_argument("--enforce-limits", action="store_true",
+                        help="answer 429 when Telegram's global/per-chat flood limits are exceeded")
+    parser.add_argument("--member-status", default="member", choices=MEMBER_STATUSES,
+                        help="getChatMember status for users without an override")
+    return parser.parse_args(argv)
+
+
+def main_cli():
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    args = parse_args()
+    logger.info("Fake Telegram Bot API on http://%s:%s", args.host, args.port)
+    web.run_app(build_app(Config(args)), host=args.host, port=args.port, print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main_cli()
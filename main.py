@@ -1,41 +1,153 @@
 import logging
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
+import logging.handlers
+from telegram.ext import Application, BaseRateLimiter, CommandHandler, CallbackQueryHandler, ContextTypes, \
+    InlineQueryHandler, MessageHandler, filters
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, KeyboardButton, \
-    ReplyKeyboardMarkup
-from telegram.error import TelegramError, Forbidden, BadRequest
+    ReplyKeyboardMarkup, InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent
+from telegram.error import TelegramError, Forbidden, BadRequest, RetryAfter
 from aiohttp import web
-import queue
 import asyncio
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import time
 import os
 import json
+import hmac
 import re
-from threading import Lock
+import signal
+import sys
+import threading
+import queue
+import atexit
+import gzip
+import glob
+import shutil
+import tempfile
+from contextlib import contextmanager, asynccontextmanager
+import copy
+import contextvars
+import random
+import heapq
+import itertools
+import bisect
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 # تنظیم لاگ‌گیری
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG,
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
-)
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "telegram=WARNING,httpx=WARNING,httpcore=WARNING")  # logger=LEVEL,...
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")  # خالی = فقط کنسول
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", 3))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10000))
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 1))  # سهم لاگ‌های DEBUG و لاگ‌های هر آپدیت که نوشته می‌شوند
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+LOG_SAMPLED = {"sampled": True}  # extra برای لاگ‌های پرتکرار سطح INFO که نمونه‌برداری می‌شوند
+LOG_STATE = {"listener": None}
+
+# حذف توکن ربات و رمزها از متن لاگ
+class SecretRedactor:
+    TOKEN_RE = re.compile(r"\d{6,}:[A-Za-z0-9_-]{30,}")
+
+    def __init__(self, secrets):
+        self.secrets = sorted({secret for secret in secrets if secret and len(secret) >= 4}, key=len, reverse=True)
+
+    def __call__(self, text):
+        for secret in self.secrets:
+            if secret in text:
+                text = text.replace(secret, "***")
+        return self.TOKEN_RE.sub("***", text)
+
+class RedactingFormatter(logging.Formatter):
+    def __init__(self, fmt, redact):
+        super().__init__(fmt)
+        self.redact = redact
+
+    def format(self, record):
+        return self.redact(super().format(record))
+
+# نمونه‌برداری از لاگ‌های DEBUG و لاگ‌های علامت‌خورده با LOG_SAMPLED
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.dropped = 0
+
+    def filter(self, record):
+        if self.rate >= 1 or (record.levelno > logging.DEBUG and not getattr(record, "sampled", False)):
+            return True
+        if random.random() < self.rate:
+            return True
+        self.dropped += 1
+        return False
+
+# فقط متن پیام در نخ فراخوان ساخته می‌شود؛ قالب‌بندی، پاک‌سازی و نوشتن در نخ QueueListener انجام می‌شود
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+# نشانگر پایان باید حتی با صف پر به شنونده برسد
+class LogQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+# توقف شنونده و نوشتن لاگ‌های باقی‌مانده در صف
+def stop_logging():
+    listener, LOG_STATE["listener"] = LOG_STATE["listener"], None
+    if listener is not None:
+        listener.stop()
+
+# راه‌اندازی خط لوله لاگ (در بنچمارک‌ها با تنظیمات دیگر دوباره فراخوانی می‌شود)
+def configure_logging(level=LOG_LEVEL, levels=LOG_LEVELS, log_file=LOG_FILE, sample_rate=LOG_SAMPLE_RATE,
+                      stream=None):
+    stop_logging()
+    formatter = RedactingFormatter(LOG_FORMAT, SecretRedactor(
+        os.getenv(name) for name in ("BOT_TOKEN", "WEBHOOK_SECRET", "METRICS_TOKEN")
+    ))
+    handlers = [logging.StreamHandler(stream)]
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8"
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    for item in levels.split(","):
+        name, _, logger_level = item.partition("=")
+        if name.strip() and logger_level.strip():
+            logging.getLogger(name.strip()).setLevel(logger_level.strip().upper())
+    listener = LogQueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    LOG_STATE["listener"] = listener
+    return queue_handler
+
+configure_logging()
+atexit.register(stop_logging)
 logger = logging.getLogger(__name__)
-logging.getLogger('telegram').setLevel(logging.DEBUG)
-logging.getLogger('httpcore').setLevel(logging.DEBUG)
-logging.getLogger('httpx').setLevel(logging.DEBUG)
 
 # تابع ترجمه نوع آگهی
 def translate_ad_type(ad_type):
     return "آگهی" if ad_type == "ad" else "حواله"
 
-# دیکشنری و Lock برای FSM
-FSM_STATES = {}
-FSM_LOCK = Lock()
-
 # متغیرهای محیطی
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
@@ -43,102 +155,669 @@ WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
 PORT = int(os.getenv("PORT", 8080))
 CHANNEL_ID = os.getenv("CHANNEL_ID", "@bolori_car")
 CHANNEL_URL = os.getenv("CHANNEL_URL", "https://t.me/bolori_car")
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", 30))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", 1))
+OUTBOUND_CHAT_BURST = int(os.getenv("OUTBOUND_CHAT_BURST", 3))
+OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", 20 / 60))
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", 3))
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))
+UPDATE_DRAIN_TIMEOUT = float(os.getenv("UPDATE_DRAIN_TIMEOUT", 15))
+INGRESS_MAX = int(os.getenv("INGRESS_MAX", 1000))
+INGRESS_HIGH_WATERMARK = int(os.getenv("INGRESS_HIGH_WATERMARK", INGRESS_MAX * 0.8))
+INGRESS_LOW_WATERMARK = int(os.getenv("INGRESS_LOW_WATERMARK", INGRESS_MAX * 0.5))
+INGRESS_FULL_POLICY = os.getenv("INGRESS_FULL_POLICY", "shed")  # shed | redeliver
+UPDATE_DEDUP_WINDOW = int(os.getenv("UPDATE_DEDUP_WINDOW", 100000))
+UPDATE_DEDUP_CHECKPOINT_INTERVAL = float(os.getenv("UPDATE_DEDUP_CHECKPOINT_INTERVAL", 10))
+UPDATE_DEDUP_MAX_AGE = float(os.getenv("UPDATE_DEDUP_MAX_AGE", 7 * 24 * 3600))  # تلگرام پس از یک هفته بی‌آپدیتی update_id را از نو شروع می‌کند
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 8))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 30))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))
+BROADCAST_CHECKPOINT_INTERVAL = float(os.getenv("BROADCAST_CHECKPOINT_INTERVAL", 1))
+BROADCAST_FETCH_SIZE = int(os.getenv("BROADCAST_FETCH_SIZE", 500))
+BROADCAST_STOP_TIMEOUT = float(os.getenv("BROADCAST_STOP_TIMEOUT", 10))
+MEMBERSHIP_TTL = float(os.getenv("MEMBERSHIP_TTL", 600))
+MEMBERSHIP_NEGATIVE_TTL = float(os.getenv("MEMBERSHIP_NEGATIVE_TTL", 30))
+MEMBERSHIP_CACHE_SIZE = int(os.getenv("MEMBERSHIP_CACHE_SIZE", 10000))
+FSM_IDLE_TIMEOUT = float(os.getenv("FSM_IDLE_TIMEOUT", 6 * 3600))
+FSM_MAX_ENTRIES = int(os.getenv("FSM_MAX_ENTRIES", 10000))
+FSM_PERSIST = os.getenv("FSM_PERSIST", "1") == "1"
+FSM_SWEEP_INTERVAL = float(os.getenv("FSM_SWEEP_INTERVAL", 300))
+BROWSE_SESSION_TTL = float(os.getenv("BROWSE_SESSION_TTL", 1800))
+BROWSE_SESSION_MAX = int(os.getenv("BROWSE_SESSION_MAX", 10000))
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", 2000))
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", 300))
+INLINE_PAGE_SIZE = min(50, int(os.getenv("INLINE_PAGE_SIZE", 20)))
+INLINE_CACHE_SIZE = int(os.getenv("INLINE_CACHE_SIZE", 512))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # بدون توکن مسیر /metrics فعال نمی‌شود
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "").rstrip("/")  # مثلاً http://127.0.0.1:8081 برای fake_telegram.py
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 5000))  # ردیابی‌های کندتر از این همیشه ذخیره می‌شوند؛ 0 = خاموش
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", 5 * 1024 * 1024))
+TRACE_BACKUPS = int(os.getenv("TRACE_BACKUPS", 3))
+TRACE_FLUSH_INTERVAL = float(os.getenv("TRACE_FLUSH_INTERVAL", 2))
+PROFILE_ON_START = os.getenv("PROFILE_ON_START", "")  # مثل /profile: "60" ثانیه یا "500u" آپدیت
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.01))
+PROFILE_DEFAULT_SECONDS = float(os.getenv("PROFILE_DEFAULT_SECONDS", 30))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", 600))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
 
 if not all([BOT_TOKEN, WEBHOOK_URL, CHANNEL_ID, CHANNEL_URL]):
     logger.error("Missing required environment variables")
     raise ValueError("Missing required environment variables")
 
+# متریک‌های درون‌برنامه‌ای با خروجی متنی Prometheus
+METRICS = []
+METRICS_MAX_SERIES = 200  # سقف ترکیب‌های برچسب هر متریک؛ بقیه در "other" جمع می‌شوند
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+def format_labels(names, values, extra=""):
+    pairs = [
+        f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+        for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+# پایه متریک‌ها؛ collect در صورت وجود مقدارها را هنگام خواندن /metrics می‌دهد
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labels=(), collect=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.collect = collect
+        self._values = {}
+        METRICS.append(self)
+
+    def _series(self, labels):
+        if labels in self._values or len(self._values) < METRICS_MAX_SERIES:
+            return labels
+        return ("other",) * len(self.labels)
+
+    def samples(self):
+        values = self.collect() if self.collect else self._values
+        for labels, value in values.items():
+            yield self.name, format_labels(self.labels, labels), value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {value}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        labels = self._series(labels)
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, labels=()):
+        self._values[self._series(labels)] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        labels = self._series(labels)
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", format_labels(self.labels, labels, f'le="{bound}"'), cumulative
+            yield f"{self.name}_sum", format_labels(self.labels, labels), total
+            yield f"{self.name}_count", format_labels(self.labels, labels), cumulative
+
+def render_metrics():
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
+
+UPDATE_QUEUE_DEPTH = Gauge(
+    "bot_update_queue_depth", "Updates waiting in each worker queue", ("worker",),
+    collect=lambda: {(str(i),): queue.qsize() for i, queue in enumerate(update_queues)}
+)
+INGRESS_UPDATES = Counter(
+    "bot_ingress_updates_total", "Webhook updates by admission decision", ("decision",),
+    collect=lambda: {(decision,): count for decision, count in INGRESS_STATS.items()}
+)
+UPDATE_QUEUE_WAIT = Histogram("bot_update_queue_wait_seconds", "Time from webhook receipt to handler start")
+UPDATE_PROCESSING = Histogram("bot_update_processing_seconds", "Time spent processing one update")
+HANDLER_LATENCY = Histogram("bot_handler_seconds", "Handler latency", ("handler",))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Handler exceptions", ("handler",))
+BOT_API_LATENCY = Histogram("bot_api_request_seconds", "Bot API call latency (excluding throttling)", ("method",))
+BOT_API_ERRORS = Counter("bot_api_errors_total", "Bot API call errors", ("method", "error"))
+BOT_API_THROTTLE_WAIT = Histogram("bot_api_throttle_wait_seconds", "Time spent waiting for outbound rate limits",
+                                  ("priority",))
+DB_LATENCY = Histogram("bot_db_call_seconds", "SQLite call latency including the wait for the DB thread",
+                       ("op",))
+DB_WRITE_BATCH = Histogram("bot_db_write_batch_size", "Statements per group commit",
+                           buckets=(1, 2, 5, 10, 25, 50, 100, 200, 500))
+BROADCAST_DELIVERIES = Counter("bot_broadcast_deliveries_total", "Broadcast deliveries by result", ("result",))
+BROADCASTS_ACTIVE = Gauge(
+    "bot_broadcasts_active", "Broadcast jobs currently running",
+    collect=lambda: {(): len(BROADCAST_TASKS)}
+)
+CACHE_REQUESTS = Counter(
+    "bot_cache_requests_total", "In-process cache lookups", ("cache", "result"),
+    collect=lambda: {
+        (name, result): getattr(cache, attribute)
+        for name, cache in (("render", RENDER_CACHE), ("membership", MEMBERSHIP_CACHE), ("inline", INLINE_CACHE))
+        for result, attribute in (("hit", "hits"), ("miss", "misses"))
+    }
+)
+
+# اندازه‌گیری زمان اجرای یک هندلر تلگرام
+def instrument_handler(name, callback, label=None):
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        handler = name
+        error = None
+        try:
+            if label is not None:
+                handler = label(update)
+            return await callback(update, context)
+        except Exception as e:
+            error = type(e).__name__
+            HANDLER_ERRORS.inc((handler,))
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, (handler,))
+            trace = CURRENT_TRACE.get()
+            if trace is not None:
+                trace.add("handler", started, handler=handler, error=error)
+    return wrapper
+
+# پروفایلر با این شیء کد، فریم هندلر را در پشته پیدا می‌کند
+INSTRUMENTED_HANDLER_CODE = instrument_handler("", None).__code__
+
+# برچسب callback بدون شناسه‌ها (approve_ad_12 -> approve_ad)
+CALLBACK_LABEL_RE = re.compile(r"^[A-Za-z_]*?(?=_\d|$)")
+
+def callback_label(update):
+    data = update.callback_query.data if update.callback_query else ""
+    match = CALLBACK_LABEL_RE.match(data or "")
+    return f"callback:{(match.group() if match else '')[:40] or 'unknown'}"
+
+# ردیابی هر آپدیت از دریافت در webhook تا آخرین درخواست به API تلگرام
+CURRENT_TRACE = contextvars.ContextVar("current_trace", default=None)
+TRACING = TRACE_SAMPLE_RATE > 0 or TRACE_SLOW_MS > 0
+TRACE_MAX_SPANS = 500
+
+class Trace:
+    __slots__ = ("trace_id", "update_id", "kind", "user_id", "received_at", "started", "sampled", "spans",
+                 "finished")
+
+    def __init__(self, json_data, started):
+        self.trace_id = os.urandom(8).hex()
+        self.update_id = json_data.get("update_id")
+        self.kind = next((key for key in json_data if key != "update_id"), None)
+        self.user_id = update_shard_key(json_data)
+        self.received_at = time.time()
+        self.started = started
+        self.sampled = random.random() < TRACE_SAMPLE_RATE
+        self.spans = []
+        self.finished = False
+
+    # ثبت یک بازه؛ بازه‌هایی که بعد از پایان ردیابی می‌رسند (مثلاً از تسک‌های پس‌زمینه) نادیده گرفته می‌شوند
+    def add(self, name, started, ended=None, **attrs):
+        if self.finished or len(self.spans) >= TRACE_MAX_SPANS:
+            return
+        self.spans.append((name, started, ended or time.perf_counter(), attrs))
+
+    def finish(self, error=None):
+        self.finished = True
+        duration = time.perf_counter() - self.started
+        if self.sampled or (TRACE_SLOW_MS and duration * 1000 >= TRACE_SLOW_MS):
+            TRACE_EXPORTER.submit(self.to_record(duration, error))
+
+    def to_record(self, duration, error):
+        spans = []
+        for name, started, ended, attrs in self.spans:
+            span = {"name": name, "start_ms": round((started - self.started) * 1000, 3),
+                    "duration_ms": round((ended - started) * 1000, 3)}
+            span.update((key, value) for key, value in attrs.items() if value is not None)
+            spans.append(span)
+        return {
+            "trace_id": self.trace_id, "update_id": self.update_id, "kind": self.kind, "user_id": self.user_id,
+            "received_at": round(self.received_at, 3), "duration_ms": round(duration * 1000, 3),
+            "sampled": self.sampled, "error": error, "spans": spans,
+        }
+
+# نوشتن ردیابی‌ها به صورت JSON lines در فایل چرخشی، خارج از حلقه رویداد
+class TraceExporter:
+    MAX_BUFFERED = 10000
+
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self._buffer = []
+        self._lock = asyncio.Lock()
+
+    def submit(self, record):
+        if len(self._buffer) >= self.MAX_BUFFERED:
+            self.dropped += 1
+            return
+        self._buffer.append(record)
+
+    async def flush(self):
+        async with self._lock:
+            if not self._buffer:
+                return
+            records, self._buffer = self._buffer, []
+            try:
+                await asyncio.to_thread(self._write, records)
+            except OSError as e:
+                logger.error(f"Cannot write {len(records)} traces to {self.path}: {e}")
+
+    def _write(self, records):
+        data = "".join(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n" for record in records)
+        try:
+            if os.path.getsize(self.path) + len(data) > self.max_bytes:
+                self._rotate()
+        except FileNotFoundError:
+            pass
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+
+    def _rotate(self):
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+TRACE_EXPORTER = TraceExporter(TRACE_FILE, TRACE_MAX_BYTES, TRACE_BACKUPS)
+
+# ذخیره دوره‌ای ردیابی‌ها
+async def flush_traces():
+    while True:
+        await asyncio.sleep(TRACE_FLUSH_INTERVAL)
+        await TRACE_EXPORTER.flush()
+
 # متغیرهای جهانی
-update_queue = queue.Queue()
+update_queues = []
+update_workers = []
+INGRESS_STATS = {"accepted": 0, "shed": 0, "redelivered": 0}
+INGRESS_OVERLOADED = False
 app = web.Application()
 APPLICATION = None
 ADMIN_ID = [6583827696, 8122737247]
-current_pages = {}
+PAGE_SIZE = 5
+BROADCAST_TASKS = {}  # تسک -> Broadcast
 
 # مسیر دیتابیس
 DATABASE_PATH = "database.db"
 BACKUP_PATH = "backup.json"
-
-# اتصال به دیتابیس
-def get_db_connection():
-    conn = sqlite3.connect(DATABASE_PATH)
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_DEBOUNCE = float(os.getenv("BACKUP_DEBOUNCE", 30))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", 5))
+BACKUP_COMPRESS = os.getenv("BACKUP_COMPRESS", "1") == "1"
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", 256))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", 8192))
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", 256))
+DB_WRITE_FLUSH_MS = float(os.getenv("DB_WRITE_FLUSH_MS", 5))
+DB_WRITE_BATCH_MAX = int(os.getenv("DB_WRITE_BATCH_MAX", 200))
+# FULL: هر commit گروهی پیش از اعلام موفقیت روی دیسک fsync می‌شود؛ NORMAL در WAL ممکن است آخرین تراکنش‌ها را با قطع برق از دست بدهد
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "FULL").upper()
+if DB_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise ValueError(f"Invalid DB_SYNCHRONOUS: {DB_SYNCHRONOUS}")
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", 1024))
+
+# یکسان‌سازی متن فارسی برای جست‌وجو (ی/ي، ک/ك، ارقام فارسی و عربی، نیم‌فاصله)
+FA_NORMALIZE_TABLE = str.maketrans({
+    "ي": "ی", "ى": "ی", "ك": "ک", "ة": "ه", "\u200c": " ", "\u200f": None, "\u0640": None,
+    **{chr(0x06F0 + d): str(d) for d in range(10)},
+    **{chr(0x0660 + d): str(d) for d in range(10)},
+})
+
+def normalize_fa(text):
+    if text is None:
+        return None
+    return str(text).translate(FA_NORMALIZE_TABLE).lower()
+
+# تنظیمات اتصال دیتابیس (WAL و کش)
+def configure_connection(conn):
     conn.row_factory = sqlite3.Row
+    conn.create_function("normalize_fa", 1, normalize_fa, deterministic=True)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA busy_timeout=5000")
     return conn
 
-# بکاپ‌گیری از دیتابیس
+# لایه دیتابیس: یک اتصال ماندگار که فقط روی یک رشته اختصاصی استفاده می‌شود
+class Database:
+    def __init__(self, path):
+        self.path = path
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+        self._pending_writes = []
+        self._flush_timer = None
+
+    def _call(self, fn, *args):
+        if self._conn is None:
+            self._conn = configure_connection(
+                sqlite3.connect(self.path, cached_statements=DB_STATEMENT_CACHE)
+            )
+        return fn(self._conn, *args)
+
+    # اجرا از کد همگام (هنگام راه‌اندازی)
+    def run_sync(self, fn, *args):
+        return self._executor.submit(self._call, fn, *args).result()
+
+    # اجرا از هندلرهای async بدون مسدود کردن حلقه رویداد
+    async def run(self, fn, *args, op=None):
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, fn, *args)
+        finally:
+            DB_LATENCY.observe(time.perf_counter() - started, (op or fn.__name__,))
+            trace = CURRENT_TRACE.get()
+            if trace is not None:
+                trace.add("db", started, op=op or fn.__name__)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone(), op="fetchone")
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall(), op="fetchall")
+
+    async def execute(self, sql, params=()):
+        def op(conn):
+            with conn:
+                cursor = conn.execute(sql, params)
+            return cursor
+        return await self.run(op, op="execute")
+
+    async def executemany(self, sql, seq_of_params):
+        def op(conn):
+            with conn:
+                return conn.executemany(sql, seq_of_params).rowcount
+        return await self.run(op, op="executemany")
+
+    # نوشتن گروهی: نوشتن‌ها جمع می‌شوند و در یک تراکنش ثبت می‌شوند
+    async def write(self, sql, params=()):
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        self._pending_writes.append((sql, params, future))
+        if len(self._pending_writes) >= DB_WRITE_BATCH_MAX:
+            asyncio.create_task(self.flush())
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(
+                DB_WRITE_FLUSH_MS / 1000, lambda: asyncio.create_task(self.flush())
+            )
+        try:
+            return await future
+        finally:
+            trace = CURRENT_TRACE.get()
+            if trace is not None:
+                trace.add("db", started, op="write")
+
+    async def flush(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        batch, self._pending_writes = self._pending_writes, []
+        if not batch:
+            return
+        DB_WRITE_BATCH.observe(len(batch))
+        try:
+            results = await self.run(self._apply_writes, [(sql, params) for sql, params, _ in batch],
+                                     op="write_batch")
+        except Exception as e:
+            results = [(False, e)] * len(batch)
+        for (_, _, future), (ok, value) in zip(batch, results):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    @staticmethod
+    def _apply_writes(conn, writes):
+        try:
+            with conn:
+                return [(True, conn.execute(sql, params)) for sql, params in writes]
+        except sqlite3.Error:
+            if len(writes) == 1:
+                raise
+        # در صورت خطا، هر نوشتن جداگانه اجرا می‌شود تا خطای یکی بقیه را از بین نبرد
+        results = []
+        for sql, params in writes:
+            try:
+                with conn:
+                    results.append((True, conn.execute(sql, params)))
+            except sqlite3.Error as e:
+                results.append((False, e))
+        return results
+
+    def close(self):
+        def op(conn):
+            conn.close()
+            self._conn = None
+        if self._conn is not None:
+            self.run_sync(op)
+
+DB = Database(DATABASE_PATH)
+
+# زمان آخرین تغییر دیتابیس (با در نظر گرفتن فایل WAL)
+def database_mtime():
+    return max(
+        (os.path.getmtime(path) for path in (DATABASE_PATH, DATABASE_PATH + "-wal") if os.path.exists(path)),
+        default=0
+    )
+
+# وضعیت بکاپ‌گیری پس‌زمینه
+BACKUP_STATE = {"dirty": False, "task": None}
+BACKUP_LOCK = threading.Lock()  # اسنپ‌شات‌ها (و چرخش فایل‌ها) یکی‌یکی نوشته می‌شوند
+
+# فهرست اسنپ‌شات‌های بکاپ (قدیمی‌ترین اول)
+def list_snapshots():
+    return sorted(
+        glob.glob(os.path.join(BACKUP_DIR, "database-*.db")) +
+        glob.glob(os.path.join(BACKUP_DIR, "database-*.db.gz"))
+    )
+
+# نوشتن یک اسنپ‌شات با API بکاپ آنلاین SQLite (روی رشته پس‌زمینه اجرا می‌شود)
+def write_snapshot():
+    with BACKUP_LOCK:
+        return _write_snapshot()
+
+def _write_snapshot():
+    start_time = time.monotonic()
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    snapshot_path = os.path.join(BACKUP_DIR, f"database-{datetime.now():%Y%m%d-%H%M%S-%f}.db")
+    raw_tmp_path = snapshot_path + ".tmp"
+    source = sqlite3.connect(DATABASE_PATH)
+    target = sqlite3.connect(raw_tmp_path)
+    try:
+        source.backup(target, pages=BACKUP_PAGES_PER_STEP, sleep=0.005)
+        source_mtime = database_mtime()
+    finally:
+        target.close()
+        source.close()
+
+    if BACKUP_COMPRESS:
+        snapshot_path += ".gz"
+        tmp_path = snapshot_path + ".tmp"
+        with open(raw_tmp_path, 'rb') as raw, gzip.open(tmp_path, 'wb', compresslevel=6) as compressed:
+            shutil.copyfileobj(raw, compressed)
+        os.remove(raw_tmp_path)
+    else:
+        tmp_path = raw_tmp_path
+    with open(tmp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    # زمان اسنپ‌شات برابر زمان آخرین تغییر دیتابیس منبع است تا در بازیابی قابل مقایسه باشد
+    os.utime(tmp_path, (source_mtime, source_mtime))
+    os.replace(tmp_path, snapshot_path)
+
+    for old_snapshot in list_snapshots()[:-max(1, BACKUP_KEEP)]:
+        os.remove(old_snapshot)
+    logger.debug(f"Database snapshot {snapshot_path} written in {time.monotonic() - start_time:.2f} seconds")
+    return snapshot_path
+
+async def _debounced_backup():
+    while BACKUP_STATE["dirty"]:
+        await asyncio.sleep(BACKUP_DEBOUNCE)
+        BACKUP_STATE["dirty"] = False
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, write_snapshot)
+        except Exception as e:
+            logger.error(f"Error during database backup: {e}", exc_info=True)
+
+# درخواست بکاپ‌گیری از دیتابیس (درخواست‌های پشت سر هم در یک بکاپ ادغام می‌شوند)
 def backup_db():
-    logger.debug("Backing up database...")
+    BACKUP_STATE["dirty"] = True
+    task = BACKUP_STATE["task"]
+    if task is None or task.done():
+        BACKUP_STATE["task"] = asyncio.create_task(_debounced_backup())
+
+# بکاپ‌گیری فوری (هنگام خاموش شدن)؛ اسنپ‌شاتی که در حال نوشتن است تمام می‌شود و بعد اسنپ‌شات نهایی نوشته می‌شود
+async def backup_now():
+    task = BACKUP_STATE["task"]
+    if task and not task.done():
+        task.cancel()
+    BACKUP_STATE["dirty"] = False
     try:
-        with get_db_connection() as conn:
-            users = conn.execute("SELECT * FROM users").fetchall()
-            ads = conn.execute("SELECT * FROM ads").fetchall()
-            admins = conn.execute("SELECT * FROM admins").fetchall()
-        
-        backup_data = {
-            "users": [dict(row) for row in users],
-            "ads": [dict(row) for row in ads],
-            "admins": [dict(row) for row in admins]
-        }
-        
-        with open(BACKUP_PATH, 'w') as f:
-            json.dump(backup_data, f, ensure_ascii=False)
-        logger.debug("Database backup created successfully.")
+        await asyncio.get_running_loop().run_in_executor(None, write_snapshot)
     except Exception as e:
         logger.error(f"Error during database backup: {e}", exc_info=True)
 
+# ستون‌های جداول بکاپ
+BACKUP_TABLES = {
+    "users": ("user_id", "joined"),
+    "ads": ("id", "user_id", "type", "title", "description", "price", "created_at", "status", "image_id", "phone"),
+    "admins": ("user_id",),
+}
+
+# زمان‌سنجی مراحل راه‌اندازی
+@contextmanager
+def log_timing(phase):
+    start_time = time.monotonic()
+    yield
+    logger.info(f"Startup phase '{phase}' took {time.monotonic() - start_time:.3f} seconds")
+
+# آیا بازیابی لازم است؟ (دیتابیس وجود ندارد یا از آخرین بکاپ قدیمی‌تر است)
+def restore_needed(db_existed):
+    snapshots = list_snapshots()
+    if snapshots:
+        backup_mtime = os.path.getmtime(snapshots[-1])
+    elif os.path.exists(BACKUP_PATH):
+        backup_mtime = os.path.getmtime(BACKUP_PATH)
+    else:
+        return False
+    if not db_existed:
+        logger.info("Database file is missing, restoring from backup")
+        return True
+    if database_mtime() < backup_mtime:
+        logger.info("Database is older than the latest backup, restoring")
+        return True
+    return False
+
+# جایگزینی داده‌ها در یک تراکنش با درج دسته‌ای
+def _replace_tables(conn, rows_by_table):
+    with conn:
+        for table in BACKUP_TABLES:
+            conn.execute(f"DELETE FROM {table}")
+        for table, columns in BACKUP_TABLES.items():
+            conn.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                rows_by_table(table, columns)
+            )
+
+# بازیابی از اسنپ‌شات (ردیف‌ها به صورت جریانی خوانده و درج می‌شوند)
+def _restore_from_snapshot(conn, snapshot_path):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if snapshot_path.endswith(".gz"):
+            db_path = os.path.join(tmp_dir, "snapshot.db")
+            with gzip.open(snapshot_path, 'rb') as compressed, open(db_path, 'wb') as raw:
+                shutil.copyfileobj(compressed, raw)
+        else:
+            db_path = snapshot_path
+        snapshot = sqlite3.connect(db_path)
+        try:
+            _replace_tables(
+                conn,
+                lambda table, columns: snapshot.execute(f"SELECT {', '.join(columns)} FROM {table}")
+            )
+        finally:
+            snapshot.close()
+
+# بازیابی از فایل JSON قدیمی (فقط وقتی هیچ اسنپ‌شاتی وجود ندارد)
+def _restore_from_json(conn, json_path):
+    with open(json_path, 'r') as f:
+        backup_data = json.load(f)
+    _replace_tables(
+        conn,
+        lambda table, columns: (tuple(row[c] for c in columns) for row in backup_data.get(table, []))
+    )
+
 # بازیابی دیتابیس
 def restore_db():
     logger.debug("Restoring database...")
-    if not os.path.exists(BACKUP_PATH):
-        logger.debug("No backup file found, skipping restore.")
-        return
-    
     try:
-        with open(BACKUP_PATH, 'r') as f:
-            backup_data = json.load(f)
-        
-        with get_db_connection() as conn:
-            # پاک کردن جداول فعلی
-            conn.execute("DELETE FROM users")
-            conn.execute("DELETE FROM ads")
-            conn.execute("DELETE FROM admins")
-            
-            # بازیابی کاربران
-            for user in backup_data.get("users", []):
-                conn.execute(
-                    "INSERT INTO users (user_id, joined) VALUES (?, ?)",
-                    (user["user_id"], user["joined"])
-                )
-            
-            # بازیابی آگهی‌ها
-            for ad in backup_data.get("ads", []):
-                conn.execute(
-                    """
-                    INSERT INTO ads (id, user_id, type, title, description, price, created_at, status, image_id, phone)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (
-                        ad["id"], ad["user_id"], ad["type"], ad["title"], ad["description"],
-                        ad["price"], ad["created_at"], ad["status"], ad["image_id"], ad["phone"]
-                    )
-                )
-            
-            # بازیابی ادمین‌ها
-            for admin in backup_data.get("admins", []):
-                conn.execute(
-                    "INSERT INTO admins (user_id) VALUES (?)",
-                    (admin["user_id"],)
-                )
-            
-            conn.commit()
+        snapshots = list_snapshots()
+        if snapshots:
+            DB.run_sync(_restore_from_snapshot, snapshots[-1])
+        elif os.path.exists(BACKUP_PATH):
+            DB.run_sync(_restore_from_json, BACKUP_PATH)
+        else:
+            logger.debug("No backup file found, skipping restore.")
+            return
         logger.debug("Database restored successfully.")
     except Exception as e:
         logger.error(f"Error during database restore: {e}", exc_info=True)
 
+# جدول FTS5 جست‌وجو و تریگرهای همگام‌سازی آن با ads
+def create_search_index(conn):
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ads_fts'"
+    ).fetchone()
+    conn.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS ads_fts
+                  USING fts5(title, description, tokenize = 'unicode61 remove_diacritics 2')''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS ads_fts_insert AFTER INSERT ON ads BEGIN
+                      INSERT INTO ads_fts (rowid, title, description)
+                      VALUES (new.id, normalize_fa(new.title), normalize_fa(new.description));
+                  END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS ads_fts_delete AFTER DELETE ON ads BEGIN
+                      DELETE FROM ads_fts WHERE rowid = old.id;
+                  END''')
+    conn.execute('''CREATE TRIGGER IF NOT EXISTS ads_fts_update AFTER UPDATE OF title, description ON ads BEGIN
+                      DELETE FROM ads_fts WHERE rowid = old.id;
+                      INSERT INTO ads_fts (rowid, title, description)
+                      VALUES (new.id, normalize_fa(new.title), normalize_fa(new.description));
+                  END''')
+    if not exists:
+        conn.execute('''INSERT INTO ads_fts (rowid, title, description)
+                        SELECT id, normalize_fa(title), normalize_fa(description) FROM ads''')
+
 # مقداردهی اولیه دیتابیس
 def init_db():
     logger.debug("Initializing database...")
-    with get_db_connection() as conn:
+    needs_restore = restore_needed(os.path.exists(DATABASE_PATH))
+
+    def create_schema(conn):
         conn.execute('''CREATE TABLE IF NOT EXISTS users
                       (user_id INTEGER PRIMARY KEY, joined TEXT)''')
         conn.execute('''CREATE TABLE IF NOT EXISTS ads
@@ -156,18 +835,181 @@ def init_db():
                       ON ads (status, created_at DESC)''')
         conn.execute('''CREATE INDEX IF NOT EXISTS idx_users_id 
                       ON users (user_id)''')
+        # فهرست‌ها و فیلترها به ترتیب (created_at, id) خوانده می‌شوند؛ price در انتهای ایندکس است تا
+        # فیلتر قیمت بدون مراجعه به جدول و بدون مرتب‌سازی کل بازه قیمت انجام شود
+        for index in ("idx_ads_listing", "idx_ads_type_price", "idx_ads_price"):
+            conn.execute(f"DROP INDEX IF EXISTS {index}")
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_ads_listing_price
+                      ON ads (status, type, created_at, id, price)''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_ads_recent_price
+                      ON ads (status, created_at, id, price)''')
+        conn.execute("UPDATE ads SET created_at = '' WHERE created_at IS NULL")
+        conn.execute('''CREATE TABLE IF NOT EXISTS bot_state
+                      (key TEXT PRIMARY KEY, value BLOB)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS broadcast_jobs
+                      (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT, payload TEXT, label TEXT,
+                       admin_chat_id INTEGER, status_message_id INTEGER, status TEXT,
+                       cursor INTEGER DEFAULT 0, total INTEGER DEFAULT 0, sent INTEGER DEFAULT 0,
+                       failed INTEGER DEFAULT 0, created_at TEXT, finished_at TEXT)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS broadcast_deliveries
+                      (job_id INTEGER, user_id INTEGER, status TEXT DEFAULT 'pending',
+                       PRIMARY KEY (job_id, user_id)) WITHOUT ROWID''')
+        conn.execute('''CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status
+                      ON broadcast_jobs (status)''')
+        conn.execute('''CREATE TABLE IF NOT EXISTS fsm_states
+                      (user_id INTEGER PRIMARY KEY, data TEXT, updated_at REAL)''')
+        create_search_index(conn)
         conn.commit()
-        logger.debug("Database initialized successfully.")
-    restore_db()  # بازیابی دیتابیس بعد از مقداردهی اولیه
+
+    with log_timing("schema"):
+        DB.run_sync(create_schema)
+    logger.debug("Database initialized successfully.")
+    if needs_restore:
+        with log_timing("restore"):
+            restore_db()  # بازیابی دیتابیس بعد از مقداردهی اولیه
 
 # بارگذاری ادمین‌ها
 def load_admins():
     logger.debug("Loading admin IDs...")
-    with get_db_connection() as conn:
-        admins = conn.execute('SELECT user_id FROM admins').fetchall()
-        admin_ids = [admin['user_id'] for admin in admins]
-        logger.debug(f"Loaded {len(admin_ids)} admin IDs")
-        return admin_ids
+    admins = DB.run_sync(lambda conn: conn.execute('SELECT user_id FROM admins').fetchall())
+    admin_ids = [admin['user_id'] for admin in admins]
+    logger.debug(f"Loaded {len(admin_ids)} admin IDs")
+    return admin_ids
+
+# ذخیره‌ساز وضعیت FSM با قفل async برای هر کاربر، انقضا و ذخیره در دیتابیس
+class FSMStore:
+    def __init__(self, idle_timeout=FSM_IDLE_TIMEOUT, max_entries=FSM_MAX_ENTRIES, persist=FSM_PERSIST):
+        self.idle_timeout = idle_timeout
+        self.max_entries = max_entries
+        self.persist = persist
+        self._states = OrderedDict()  # user_id -> (data, updated_at)
+        self._locks = {}  # user_id -> [asyncio.Lock, تعداد استفاده‌کننده‌ها]
+        self._spilled = False  # آیا وضعیتی فقط در دیتابیس مانده است
+
+    def __len__(self):
+        return len(self._states)
+
+    def load(self):
+        if not self.persist:
+            return
+        cutoff = time.time() - self.idle_timeout
+
+        def op(conn):
+            with conn:
+                conn.execute("DELETE FROM fsm_states WHERE updated_at < ?", (cutoff,))
+            return conn.execute(
+                "SELECT user_id, data, updated_at FROM fsm_states ORDER BY updated_at DESC LIMIT ?",
+                (self.max_entries + 1,)
+            ).fetchall()
+
+        rows = DB.run_sync(op)
+        self._spilled = len(rows) > self.max_entries
+        for row in reversed(rows[:self.max_entries]):
+            self._states[row['user_id']] = (safe_json_loads(row['data']) or {}, row['updated_at'])
+        logger.info(f"Loaded {len(self._states)} FSM states")
+
+    async def _load(self, user_id):
+        entry = self._states.get(user_id)
+        if entry is not None:
+            if time.time() - entry[1] <= self.idle_timeout:
+                self._states.move_to_end(user_id)
+                return entry[0]
+            await self._drop(user_id)
+            return {}
+        if not (self.persist and self._spilled):
+            return {}
+        row = await DB.fetchone(
+            "SELECT data, updated_at FROM fsm_states WHERE user_id = ? AND updated_at >= ?",
+            (user_id, time.time() - self.idle_timeout)
+        )
+        if not row:
+            return {}
+        data = safe_json_loads(row['data']) or {}
+        self._remember(user_id, data, row['updated_at'])
+        return data
+
+    def _remember(self, user_id, data, updated_at):
+        self._states[user_id] = (data, updated_at)
+        self._states.move_to_end(user_id)
+        while len(self._states) > self.max_entries:
+            self._states.popitem(last=False)
+            self._spilled = self.persist
+
+    async def _store(self, user_id, data):
+        updated_at = time.time()
+        self._remember(user_id, data, updated_at)
+        if self.persist:
+            await DB.write(
+                "INSERT OR REPLACE INTO fsm_states (user_id, data, updated_at) VALUES (?, ?, ?)",
+                (user_id, json.dumps(data, ensure_ascii=False), updated_at)
+            )
+
+    async def _drop(self, user_id):
+        existed = self._states.pop(user_id, None) is not None
+        if self.persist:
+            await DB.write("DELETE FROM fsm_states WHERE user_id = ?", (user_id,))
+        return existed
+
+    # خواندن-تغییر-نوشتن اتمیک؛ داخل این بلوک نباید درخواست شبکه زد
+    @asynccontextmanager
+    async def edit(self, user_id):
+        slot = self._locks.get(user_id)
+        if slot is None:
+            slot = self._locks[user_id] = [asyncio.Lock(), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                data = copy.deepcopy(await self._load(user_id))
+                yield data
+                if data:
+                    await self._store(user_id, data)
+                else:
+                    await self._drop(user_id)
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self._locks[user_id]
+
+    async def get(self, user_id):
+        return copy.deepcopy(await self._load(user_id))
+
+    async def set(self, user_id, data):
+        async with self.edit(user_id) as state:
+            state.clear()
+            state.update(data)
+
+    async def update(self, user_id, **fields):
+        async with self.edit(user_id) as state:
+            state.update(fields)
+            return dict(state)
+
+    async def clear(self, user_id):
+        async with self.edit(user_id) as state:
+            existed = bool(state)
+            state.clear()
+        return existed
+
+    async def sweep(self):
+        cutoff = time.time() - self.idle_timeout
+        expired = [user_id for user_id, (_, updated_at) in self._states.items() if updated_at < cutoff]
+        for user_id in expired:
+            if user_id not in self._locks:
+                del self._states[user_id]
+        if self.persist:
+            await DB.write("DELETE FROM fsm_states WHERE updated_at < ?", (cutoff,))
+        if expired:
+            logger.debug(f"Evicted {len(expired)} idle FSM states")
+
+FSM_STORE = FSMStore()
+
+# پاک‌سازی دوره‌ای وضعیت‌های رهاشده
+async def sweep_fsm_states():
+    while True:
+        await asyncio.sleep(FSM_SWEEP_INTERVAL)
+        try:
+            await FSM_STORE.sweep()
+        except Exception as e:
+            logger.error(f"Error sweeping FSM states: {e}", exc_info=True)
 
 # پردازش ایمن JSON
 def safe_json_loads(data):
@@ -179,21 +1021,8 @@ def safe_json_loads(data):
         logger.warning(f"Invalid JSON in image_id: {data}")
         return [data] if data else []
 
-# تابع ارسال آگهی به تمام کاربران
-async def broadcast_ad(context: ContextTypes.DEFAULT_TYPE, ad):
-    logger.debug(f"Broadcasting ad {ad['id']} to all users")
-    try:
-        with get_db_connection() as conn:
-            users = conn.execute("SELECT user_id FROM users").fetchall()
-
-        images = safe_json_loads(ad['image_id'])
-        ad_text = (
-            f"🚗 {translate_ad_type(ad['type'])} جدید:\n"
-            f"عنوان: {ad['title']}\n"
-            f"توضیحات: {ad['description']}\n"
-            f"قیمت: {ad['price']:,} تومان\n"
-            f"📢 برای جزئیات بیشتر به ربات مراجعه کنید: @Bolori_car_bot\n"
-            f"""➖➖➖➖➖
+# پاورقی گالری زیر آگهی‌های منتشرشده
+GALLERY_FOOTER = """➖➖➖➖➖
 ☑️ اتوگالــری بلـــوری
 ▫️خرید▫️فروش▫️کارشناسی
 +989153632957
@@ -201,34 +1030,527 @@ async def broadcast_ad(context: ContextTypes.DEFAULT_TYPE, ad):
 @Bolori_Car
 جهت ثبت آگهی تان به ربات زیر مراجعه کنید.
 @bolori_car_bot"""
-        )
 
-        for user in users:
+# متن آماده و لیست مدیای یک آگهی
+class RenderedAd:
+    __slots__ = ("text", "images", "media")
+
+    def __init__(self, text, images):
+        self.text = text
+        self.images = tuple(images)
+        self.media = tuple(InputMediaPhoto(media=photo, caption=text if i == 0 else None)
+                           for i, photo in enumerate(self.images))
+
+# قالب‌های متن آگهی برای هر نوع نمایش
+AD_RENDERERS = {
+    "broadcast": lambda ad: (
+        f"🚗 {translate_ad_type(ad['type'])} جدید:\n"
+        f"عنوان: {ad['title']}\n"
+        f"توضیحات: {ad['description']}\n"
+        f"قیمت: {ad['price']:,} تومان\n"
+        f"📢 برای جزئیات بیشتر به ربات مراجعه کنید: @Bolori_car_bot\n"
+        f"{GALLERY_FOOTER}"
+    ),
+    "listing": lambda ad: (
+        f"🚗 {translate_ad_type(ad['type'])}: {ad['title']}\n"
+        f"📝 توضیحات: {ad['description']}\n"
+        f"💰 قیمت: {ad['price']:,} تومان\n"
+        f"{GALLERY_FOOTER}"
+    ),
+    "review": lambda ad: (
+        f"📋 {translate_ad_type(ad['type'])}: {ad['title']}\n"
+        f"توضیحات: {ad['description']}\n"
+        f"شماره تماس: {ad['phone']}\n"
+        f"قیمت: {ad['price']:,} تومان\n"
+        f"کاربر: {ad['user_id']}"
+    ),
+    "approved": lambda ad: (
+        f"✅ {translate_ad_type(ad['type'])} شما تأیید شد:\n"
+        f"عنوان: {ad['title']}\n"
+        f"توضیحات: {ad['description']}\n"
+        f"قیمت: {ad['price']:,} تومان\n\n"
+        f"📢 برای مشاهده آگهی‌های دیگر، از دکمه 'نمایش آگهی‌ها' استفاده کنید."
+    ),
+}
+
+# کش LRU متن و مدیای آگهی‌ها بر اساس شناسه و نسخه
+class RenderCache:
+    def __init__(self, max_entries=RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._versions = {}
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, ad_id):
+        return self._versions.get(ad_id, 0)
+
+    def get(self, ad, kind):
+        key = (ad['id'], self.version(ad['id']), kind)
+        rendered = self._entries.get(key)
+        if rendered is not None:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return rendered
+        self.misses += 1
+        rendered = RenderedAd(AD_RENDERERS[kind](ad), safe_json_loads(ad['image_id']))
+        self._entries[key] = rendered
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return rendered
+
+    def invalidate(self, ad_id):
+        self._versions[ad_id] = self.version(ad_id) + 1
+        for key in [key for key in self._entries if key[0] == ad_id]:
+            del self._entries[key]
+
+RENDER_CACHE = RenderCache()
+
+# محدودکننده نرخ (Token Bucket)
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens=1):
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            self._refill()
+            while self._tokens < tokens:
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+                self._refill()
+            self._tokens -= tokens
+
+# اولویت‌های ارسال پیام (عدد کمتر = اولویت بیشتر)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_ADMIN = 1
+PRIORITY_BULK = 2
+
+# زمان‌بند سراسری درخواست‌های خروجی به API تلگرام
+class OutboundScheduler(BaseRateLimiter):
+    THROTTLED_PREFIXES = ("send", "edit", "copy", "forward")
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, rate=OUTBOUND_RATE, max_retries=OUTBOUND_MAX_RETRIES):
+        self._global = TokenBucket(rate)
+        self._max_retries = max_retries
+        self._chats = OrderedDict()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0
+        self._dispatcher = None
+
+    async def initialize(self):
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+        for _, _, _, future in self._waiters:
+            if not future.done():
+                future.cancel()
+        self._waiters.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+            else:
+                bucket = TokenBucket(OUTBOUND_GROUP_RATE, 20)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > self.MAX_CHAT_BUCKETS:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    # توزیع سهمیه سراسری به ترتیب اولویت
+    async def _dispatch(self):
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            delay = self._paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            _, _, cost, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            await self._global.acquire(cost)
+            if not future.done():
+                future.set_result(None)
+
+    async def _acquire(self, priority, chat_id, cost):
+        if chat_id is not None:
+            await self._chat_bucket(chat_id).acquire()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), cost, future))
+        self._wakeup.set()
+        await future
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        throttled = endpoint.startswith(self.THROTTLED_PREFIXES)
+        cost = (len(data.get("media") or ()) or 1) if endpoint == "sendMediaGroup" else 1
+        trace = CURRENT_TRACE.get()
+        for attempt in range(self._max_retries + 1):
+            if throttled:
+                waited = time.perf_counter()
+                await self._acquire(priority, data.get("chat_id"), cost)
+                BOT_API_THROTTLE_WAIT.observe(time.perf_counter() - waited, (str(priority),))
+                if trace is not None:
+                    trace.add("throttle", waited, method=endpoint, priority=priority)
+            started = time.perf_counter()
+            error = None
             try:
-                if images:
-                    media = [InputMediaPhoto(media=photo, caption=ad_text if i == 0 else None)
-                             for i, photo in enumerate(images)]
-                    await context.bot.send_media_group(chat_id=user['user_id'], media=media)
-                else:
-                    await context.bot.send_message(chat_id=user['user_id'], text=ad_text)
-                await asyncio.sleep(0.1)
+                return await callback(*args, **kwargs)
             except Exception as e:
-                logger.error(f"Error broadcasting ad to user {user['user_id']}: {e}")
-        logger.debug(f"Ad {ad['id']} broadcasted to {len(users)} users")
+                error = type(e).__name__
+                BOT_API_ERRORS.inc((endpoint, error))
+                if not isinstance(e, RetryAfter) or attempt >= self._max_retries:
+                    raise
+                retry_after = e.retry_after
+            finally:
+                BOT_API_LATENCY.observe(time.perf_counter() - started, (endpoint,))
+                if trace is not None:
+                    trace.add("bot_api", started, method=endpoint, attempt=attempt or None, error=error)
+            logger.warning("Flood control on %s, retrying in %ss (attempt %s)", endpoint, retry_after, attempt + 1)
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            slept = time.perf_counter()
+            await asyncio.sleep(retry_after)
+            if trace is not None:
+                trace.add("retry_after", slept, method=endpoint)
+
+# ساخت تابع ارسال برای یک کار ارسال همگانی
+async def build_broadcast_sender(kind, payload):
+    if kind == "ad":
+        ad = await DB.fetchone("SELECT * FROM ads WHERE id = ?", (payload["ad_id"],))
+        if not ad:
+            raise ValueError(f"Ad {payload['ad_id']} not found")
+        rendered = RENDER_CACHE.get(ad, "broadcast")
+        ad_text, media = rendered.text, list(rendered.media)
+
+        async def send(bot, chat_id):
+            if media:
+                await bot.send_media_group(chat_id=chat_id, media=media, rate_limit_args=PRIORITY_BULK)
+            else:
+                await bot.send_message(chat_id=chat_id, text=ad_text, rate_limit_args=PRIORITY_BULK)
+
+        return send, max(1, len(media))
+
+    if kind == "message":
+        if payload.get("photo"):
+            async def send(bot, chat_id):
+                await bot.send_photo(
+                    chat_id=chat_id, photo=payload["photo"], caption=payload.get("caption", ""),
+                    rate_limit_args=PRIORITY_BULK
+                )
+        else:
+            async def send(bot, chat_id):
+                await bot.send_message(chat_id=chat_id, text=payload["text"], rate_limit_args=PRIORITY_BULK)
+
+        return send, 1
+
+    raise ValueError(f"Unknown broadcast kind: {kind}")
+
+# موتور ارسال همگانی
+class Broadcast:
+    def __init__(self, bot, job, send, cost):
+        self.bot = bot
+        self.job_id = job['id']
+        self.admin_chat_id = job['admin_chat_id']
+        self.status_message_id = job['status_message_id']
+        self.label = job['label']
+        self.cursor = job['cursor']
+        self.total = job['total']
+        self.sent = job['sent']
+        self.failed = job['failed']
+        self.send = send
+        self.cost = cost
+        self.started_at = None
+        self._started_done = self.sent + self.failed
+        self._queue = asyncio.Queue(maxsize=BROADCAST_FETCH_SIZE)
+        self._dispatched = deque()
+        self._done = set()
+        self._results = []
+        self._stopping = False
+
+    @property
+    def remaining(self):
+        return self.total - self.sent - self.failed
+
+    def progress_text(self, finished=False):
+        elapsed = time.monotonic() - self.started_at
+        if finished:
+            return (
+                f"✅ {self.label} به پایان رسید.\n"
+                f"ارسال‌شده: {self.sent}\n"
+                f"ناموفق: {self.failed}"
+            )
+        speed = (self.sent + self.failed - self._started_done) / elapsed if elapsed > 0 else 0
+        eta = f"{self.remaining / speed:.0f} ثانیه" if speed > 0 else "نامشخص"
+        return (
+            f"📢 {self.label} در حال انجام...\n"
+            f"ارسال‌شده: {self.sent}\n"
+            f"ناموفق: {self.failed}\n"
+            f"باقی‌مانده: {self.remaining}\n"
+            f"زمان تقریبی باقی‌مانده: {eta}"
+        )
+
+    async def _report(self, finished=False):
+        if not self.admin_chat_id:
+            return
+        try:
+            text = self.progress_text(finished)
+            if self.status_message_id is None:
+                message = await self.bot.send_message(
+                    chat_id=self.admin_chat_id, text=text, rate_limit_args=PRIORITY_ADMIN
+                )
+                self.status_message_id = message.message_id
+            else:
+                await self.bot.edit_message_text(
+                    chat_id=self.admin_chat_id, message_id=self.status_message_id, text=text,
+                    rate_limit_args=PRIORITY_ADMIN
+                )
+        except BadRequest as e:
+            logger.debug("Broadcast progress not updated: %s", e)
+        except Exception as e:
+            logger.error(f"Error reporting broadcast progress: {e}")
+
+    # ذخیره وضعیت گیرندگان و مکان‌نما
+    async def _checkpoint(self, status="running"):
+        results, self._results = self._results, []
+        while self._dispatched and self._dispatched[0] in self._done:
+            self.cursor = self._dispatched.popleft()
+            self._done.discard(self.cursor)
+        values = (
+            self.cursor, self.sent, self.failed, status, self.status_message_id,
+            datetime.now().isoformat() if status != "running" else None, self.job_id
+        )
+
+        def checkpoint(conn):
+            conn.executemany(
+                "UPDATE broadcast_deliveries SET status = ? WHERE job_id = ? AND user_id = ?",
+                [(result, self.job_id, user_id) for user_id, result in results]
+            )
+            conn.execute(
+                """
+                UPDATE broadcast_jobs SET cursor = ?, sent = ?, failed = ?, status = ?,
+                    status_message_id = ?, finished_at = ?
+                WHERE id = ?
+                """,
+                values
+            )
+            if status != "running":
+                conn.execute("DELETE FROM broadcast_deliveries WHERE job_id = ?", (self.job_id,))
+            conn.commit()
+
+        try:
+            await DB.run(checkpoint)
+        except asyncio.CancelledError:
+            # نتایج برمی‌گردند تا checkpoint بعدی آن‌ها را ثبت کند؛ بدون آن ادامه کار به گیرندگان قبلی دوباره ارسال می‌کند
+            self._results[:0] = results
+            raise
+
+    # توقف نرم: ارسال‌های در جریان تمام می‌شوند و بقیه برای ادامه پس از راه‌اندازی مجدد می‌مانند
+    def stop(self):
+        self._stopping = True
+
+    async def _producer(self, workers):
+        last_user_id = self.cursor
+        while not self._stopping:
+            rows = await DB.fetchall(
+                """
+                SELECT user_id FROM broadcast_deliveries
+                WHERE job_id = ? AND user_id > ? AND status = 'pending'
+                ORDER BY user_id LIMIT ?
+                """,
+                (self.job_id, last_user_id, BROADCAST_FETCH_SIZE)
+            )
+            if not rows:
+                break
+            for row in rows:
+                self._dispatched.append(row['user_id'])
+                await self._queue.put(row['user_id'])
+            last_user_id = rows[-1]['user_id']
+        for _ in range(workers):
+            await self._queue.put(None)
+
+    async def _worker(self, bucket):
+        while True:
+            user_id = await self._queue.get()
+            if user_id is None:
+                return
+            while not self._stopping:
+                await bucket.acquire(self.cost)
+                try:
+                    await self.send(self.bot, user_id)
+                    self.sent += 1
+                    result = "sent"
+                    BROADCAST_DELIVERIES.inc(("sent",))
+                except RetryAfter as e:
+                    logger.warning("Broadcast hit flood control, sleeping %ss", e.retry_after)
+                    await asyncio.sleep(e.retry_after)
+                    continue
+                except Exception as e:
+                    self.failed += 1
+                    result = "failed"
+                    BROADCAST_DELIVERIES.inc(("failed",))
+                    logger.debug("Broadcast to user %s failed: %s", user_id, e)
+                self._results.append((user_id, result))
+                self._done.add(user_id)
+                break
+
+    async def _checkpointer(self, finished):
+        last_report = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(finished.wait(), BROADCAST_CHECKPOINT_INTERVAL)
+                return
+            except asyncio.TimeoutError:
+                pass
+            await self._checkpoint()
+            if time.monotonic() - last_report >= BROADCAST_PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                await self._report()
+
+    async def run(self):
+        self.started_at = time.monotonic()
+        logger.info(
+            "Broadcast job %s '%s' running: %s of %s users left", self.job_id, self.label, self.remaining, self.total
+        )
+        await self._report()
+        bucket = TokenBucket(BROADCAST_RATE)
+        workers = max(1, BROADCAST_WORKERS)
+        finished = asyncio.Event()
+        checkpointer = asyncio.create_task(self._checkpointer(finished))
+        try:
+            try:
+                await asyncio.gather(self._producer(workers), *(self._worker(bucket) for _ in range(workers)))
+            finally:
+                # checkpointer لغو نمی‌شود تا checkpoint در جریان پیش از checkpoint نهایی تمام شود
+                finished.set()
+                await asyncio.shield(checkpointer)
+        except asyncio.CancelledError:
+            await self._checkpoint()
+            raise
+        if self._stopping:
+            await self._checkpoint()
+            logger.info("Broadcast job %s paused: %s sent, %s failed so far", self.job_id, self.sent, self.failed)
+            return
+        await self._checkpoint(status="done")
+        await self._report(finished=True)
+        logger.info(
+            "Broadcast job %s finished: %s sent, %s failed in %.1f seconds",
+            self.job_id, self.sent, self.failed, time.monotonic() - self.started_at
+        )
+
+# اجرای یک کار ارسال همگانی در پس‌زمینه
+async def run_broadcast_job(bot, job):
+    try:
+        send, cost = await build_broadcast_sender(job['kind'], json.loads(job['payload']))
     except Exception as e:
-        logger.error(f"Error in broadcast_ad: {e}", exc_info=True)
+        logger.error(f"Cannot run broadcast job {job['id']}: {e}", exc_info=True)
+
+        def mark_failed(conn):
+            conn.execute(
+                "UPDATE broadcast_jobs SET status = 'failed', finished_at = ? WHERE id = ?",
+                (datetime.now().isoformat(), job['id'])
+            )
+            conn.execute("DELETE FROM broadcast_deliveries WHERE job_id = ?", (job['id'],))
+            conn.commit()
+
+        await DB.run(mark_failed)
+        return None
+    broadcast = Broadcast(bot, job, send, cost)
+    # ارسال همگانی در زمینه خالی اجرا می‌شود تا به ردیابی آپدیت ادمین نچسبد (create_task زمینه جاری را کپی می‌کند)
+    task = contextvars.Context().run(asyncio.create_task, broadcast.run())
+    BROADCAST_TASKS[task] = broadcast
+    task.add_done_callback(lambda done: BROADCAST_TASKS.pop(done, None))
+    return broadcast
+
+# توقف ارسال‌های همگانی هنگام خاموش شدن و ذخیره آخرین وضعیت آن‌ها
+async def stop_broadcasts(timeout=BROADCAST_STOP_TIMEOUT):
+    if not BROADCAST_TASKS:
+        return
+    for broadcast in BROADCAST_TASKS.values():
+        broadcast.stop()
+    _, pending = await asyncio.wait(list(BROADCAST_TASKS), timeout=timeout)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.warning(f"{len(pending)} broadcast jobs did not stop in {timeout}s and were cancelled")
+        await asyncio.gather(*pending, return_exceptions=True)
+
+# درج کار ارسال همگانی و گیرندگانش؛ باید درون تراکنش فراخواننده اجرا شود
+def insert_broadcast_job(conn, kind, payload, label, admin_chat_id):
+    cursor = conn.execute(
+        """
+        INSERT INTO broadcast_jobs (kind, payload, label, admin_chat_id, status, created_at)
+        VALUES (?, ?, ?, ?, 'running', ?)
+        """,
+        (kind, json.dumps(payload, ensure_ascii=False), label, admin_chat_id, datetime.now().isoformat())
+    )
+    job_id = cursor.lastrowid
+    total = conn.execute(
+        "INSERT INTO broadcast_deliveries (job_id, user_id) SELECT ?, user_id FROM users",
+        (job_id,)
+    ).rowcount
+    conn.execute("UPDATE broadcast_jobs SET total = ? WHERE id = ?", (total, job_id))
+    return conn.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,)).fetchone()
+
+# ثبت کار ارسال همگانی و شروع آن
+async def start_broadcast(bot, admin_chat_id, kind, payload, label):
+    def create_job(conn):
+        with conn:
+            return insert_broadcast_job(conn, kind, payload, label, admin_chat_id)
+
+    job = await DB.run(create_job)
+    return await run_broadcast_job(bot, job)
+
+# ادامه کارهای ارسال همگانی ناتمام پس از راه‌اندازی مجدد
+async def resume_broadcast_jobs(bot):
+    jobs = await DB.fetchall("SELECT * FROM broadcast_jobs WHERE status = 'running' ORDER BY id")
+    for job in jobs:
+        logger.info("Resuming broadcast job %s from user %s", job['id'], job['cursor'])
+        await run_broadcast_job(bot, job)
+
+# تأیید آگهی و ثبت کار ارسال آن به همه کاربران در یک تراکنش؛ اگر ربات پیش از شروع ارسال
+# خاموش شود، resume_broadcast_jobs کار را ادامه می‌دهد
+async def approve_ad(ad, admin_chat_id=None):
+    label = f"ارسال {translate_ad_type(ad['type'])} {ad['id']}"
+
+    def approve(conn):
+        with conn:
+            conn.execute("UPDATE ads SET status = 'approved' WHERE id = ?", (ad['id'],))
+            return insert_broadcast_job(conn, "ad", {"ad_id": ad['id']}, label, admin_chat_id)
+
+    return await DB.run(approve, op="approve_ad")
 
 # مسیر Webhook
 async def webhook(request):
     logger.debug("Received webhook request")
-    logger.debug(f"Request headers: {dict(request.headers)}")
-    logger.debug(f"Request body: {await request.text()}")
 
     if not APPLICATION:
         logger.error("Application is not initialized")
         return web.Response(status=500, text='Application not initialized')
     
     start_time = time.time()
+    received = time.perf_counter()
     
     if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
         logger.warning("Invalid webhook secret token")
@@ -240,9 +1562,27 @@ async def webhook(request):
             logger.error("Empty webhook data received")
             return web.Response(status=400, text='Bad Request')
         
-        update_queue.put(json_data)
-        logger.debug(f"Queue size after putting update: {update_queue.qsize()}")
-        logger.info(f"Webhook update queued in {time.time() - start_time:.2f} seconds")
+        update_id = json_data.get("update_id")
+        if isinstance(update_id, int) and UPDATE_DEDUP.contains(update_id):
+            logger.info("Duplicate update %s ignored", update_id)
+            return web.Response(status=200)
+
+        decision = admit_update(json_data)
+        if decision == "redelivered":
+            logger.warning("Update %s rejected for redelivery, queue is full", update_id)
+            return web.Response(status=503, text='Overloaded')
+        if isinstance(update_id, int):
+            UPDATE_DEDUP.add(update_id)
+        if decision == "shed":
+            logger.info("Update %s shed under load", update_id)
+            return web.Response(status=200)
+
+        trace = None
+        if TRACING:
+            trace = Trace(json_data, received)
+            trace.add("webhook", received)
+        enqueue_update(json_data, trace)
+        logger.info("Webhook update %s queued in %.4f seconds", update_id, time.time() - start_time, extra=LOG_SAMPLED)
         return web.Response(status=200)
     
     except json.JSONDecodeError as e:
@@ -252,6 +1592,17 @@ async def webhook(request):
         logger.error(f"Error processing webhook: {e}", exc_info=True)
         return web.Response(status=500, text='Internal Server Error')
 
+# مسیر متریک‌ها با فرمت متنی Prometheus؛ بدون METRICS_TOKEN غیرفعال است چون روی پورت عمومی webhook است
+async def metrics_handler(request):
+    if not METRICS_TOKEN:
+        return web.Response(status=404, text='Not Found')
+    supplied = request.query.get("token") or request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not hmac.compare_digest(supplied.encode(), METRICS_TOKEN.encode()):
+        return web.Response(status=401, text='Unauthorized')
+    return web.Response(
+        body=render_metrics().encode(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+    )
+
 # مسیر سلامت
 async def health_check(request):
     logger.debug("Health check requested")
@@ -269,47 +1620,250 @@ async def uptime_check(request):
     logger.debug("UptimeRobot health check requested")
     return web.Response(status=200, text='OK')
 
-# پردازش صف آپدیت‌ها
-async def process_update_queue():
-    logger.debug("Starting update queue processing task...")
-    global APPLICATION
+# کلید تقسیم آپدیت‌ها بین کارگرها (بر اساس کاربر یا چت)
+def update_shard_key(json_data):
+    for key, value in json_data.items():
+        if key == "update_id" or not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            if isinstance(value.get(field), dict) and "id" in value[field]:
+                return value[field]["id"]
+        if isinstance(value.get("message"), dict):
+            return value["message"].get("chat", {}).get("id", json_data.get("update_id", 0))
+    return json_data.get("update_id", 0)
+
+# پنجره حذف آپدیت‌های تکراری (یک بیت برای هر update_id در یک بافر حلقوی)
+class UpdateDedupWindow:
+    def __init__(self, size=UPDATE_DEDUP_WINDOW):
+        self.size = size
+        self._bits = bytearray((size + 7) // 8)
+        self._max_id = None
+        self.dirty = False
+
+    def _bit(self, update_id):
+        index = update_id % self.size
+        return index >> 3, 1 << (index & 7)
+
+    # شناسه‌ای خیلی پایین‌تر از پنجره تکراری نیست؛ یعنی تلگرام شمارش update_id را از نو شروع کرده است
+    def contains(self, update_id):
+        if self._max_id is None or update_id > self._max_id or update_id <= self._max_id - self.size:
+            return False
+        byte, mask = self._bit(update_id)
+        return bool(self._bits[byte] & mask)
+
+    def reset(self):
+        self._bits = bytearray(len(self._bits))
+        self._max_id = None
+
+    def add(self, update_id):
+        if self._max_id is not None and update_id <= self._max_id - self.size:
+            logger.warning(f"update_id sequence restarted at {update_id} (window max {self._max_id}), resetting window")
+            self.reset()
+        if self._max_id is None:
+            self._max_id = update_id
+        elif update_id > self._max_id:
+            if update_id - self._max_id >= self.size:
+                self._bits = bytearray(len(self._bits))
+            else:
+                for stale_id in range(self._max_id + 1, update_id + 1):
+                    byte, mask = self._bit(stale_id)
+                    self._bits[byte] &= ~mask
+            self._max_id = update_id
+        byte, mask = self._bit(update_id)
+        self._bits[byte] |= mask
+        self.dirty = True
+
+    # قالب: max_id (۸ بایت) + زمان ذخیره (۸ بایت، ثانیه یونیکس) + بیت‌ها
+    def dump(self):
+        return (
+            (self._max_id or 0).to_bytes(8, "big", signed=True)
+            + int(time.time()).to_bytes(8, "big", signed=True)
+            + bytes(self._bits)
+        )
+
+    def load(self, data):
+        bits = data[16:]
+        if len(bits) != len(self._bits):
+            logger.warning("Update dedup window size or format changed, starting with an empty window")
+            return
+        saved_at = int.from_bytes(data[8:16], "big", signed=True)
+        if time.time() - saved_at > UPDATE_DEDUP_MAX_AGE:
+            logger.info(f"Update dedup window saved at {datetime.fromtimestamp(saved_at)} is too old, discarding")
+            return
+        self._max_id = int.from_bytes(data[:8], "big", signed=True)
+        self._bits = bytearray(bits)
+
+UPDATE_DEDUP = UpdateDedupWindow()
+
+# بارگذاری پنجره آپدیت‌های پردازش‌شده از دیتابیس
+def load_update_dedup():
+    row = DB.run_sync(lambda conn: conn.execute("SELECT value FROM bot_state WHERE key = 'update_dedup'").fetchone())
+    if row:
+        UPDATE_DEDUP.load(row['value'])
+        logger.debug("Loaded update dedup window up to update %s", UPDATE_DEDUP._max_id)
+
+# ذخیره پنجره آپدیت‌های پردازش‌شده در دیتابیس
+async def save_update_dedup():
+    if not UPDATE_DEDUP.dirty:
+        return
+    UPDATE_DEDUP.dirty = False
+    await DB.execute(
+        "INSERT OR REPLACE INTO bot_state (key, value) VALUES ('update_dedup', ?)",
+        (UPDATE_DEDUP.dump(),)
+    )
+
+async def checkpoint_update_dedup():
+    while True:
+        await asyncio.sleep(UPDATE_DEDUP_CHECKPOINT_INTERVAL)
+        try:
+            await save_update_dedup()
+        except Exception as e:
+            logger.error(f"Error saving update dedup window: {e}", exc_info=True)
+
+# ساخت صف‌های آپدیت
+def init_update_queues():
+    update_queues.clear()
+    update_queues.extend(asyncio.Queue() for _ in range(max(1, UPDATE_WORKERS)))
+
+# قرار دادن آپدیت در صف کارگر مربوط به کاربر
+def enqueue_update(json_data, trace=None):
+    shard = update_shard_key(json_data) % len(update_queues)
+    update_queues[shard].put_nowait((json_data, time.perf_counter(), trace))
+
+# تعداد آپدیت‌های در انتظار
+def update_queue_size():
+    return sum(q.qsize() for q in update_queues)
+
+# نوع آپدیت‌هایی که در زمان بار زیاد کنار گذاشته نمی‌شوند
+INGRESS_VALUABLE_KEYS = ("message", "callback_query")
+
+# تصمیم‌گیری درباره پذیرش آپدیت (accept / shed / redeliver)
+def admit_update(json_data):
+    global INGRESS_OVERLOADED
+    depth = update_queue_size()
+    if not INGRESS_OVERLOADED and depth >= INGRESS_HIGH_WATERMARK:
+        INGRESS_OVERLOADED = True
+        logger.warning("Ingress overloaded: %s updates queued", depth)
+    elif INGRESS_OVERLOADED and depth <= INGRESS_LOW_WATERMARK:
+        INGRESS_OVERLOADED = False
+        logger.info("Ingress recovered: %s updates queued", depth)
+
+    if not INGRESS_OVERLOADED or update_shard_key(json_data) in ADMIN_ID:
+        decision = "accepted"
+    elif depth >= INGRESS_MAX or INGRESS_FULL_POLICY == "redeliver":
+        decision = "redelivered"
+    elif any(key in json_data for key in INGRESS_VALUABLE_KEYS):
+        decision = "accepted"
+    else:
+        decision = "shed"
+    INGRESS_STATS[decision] += 1
+    return decision
+
+# پردازش صف آپدیت‌ها (هر کارگر آپدیت‌های کاربران خودش را به ترتیب پردازش می‌کند)
+async def process_update_queue(worker_id):
+    logger.debug("Starting update worker %s...", worker_id)
     if APPLICATION is None:
         logger.error("Application is not initialized in process_update_queue")
         return
+    update_queue = update_queues[worker_id]
     while True:
+        json_data, queued_at, trace = await update_queue.get()
+        start_time = time.perf_counter()
+        token = CURRENT_TRACE.set(trace)
+        error = None
         try:
-            json_data = update_queue.get_nowait()
-            start_time = time.time()
-            logger.debug(f"Processing update: {json_data}")
+            logger.debug("Worker %s processing update: %s", worker_id, json_data, extra=LOG_SAMPLED)
             update = Update.de_json(json_data, APPLICATION.bot)
             if update:
+                UPDATE_QUEUE_WAIT.observe(start_time - queued_at)
+                if trace is not None:
+                    trace.add("queue_wait", queued_at, start_time, worker=worker_id)
                 await APPLICATION.process_update(update)
-                logger.info(f"Processed update in {time.time() - start_time:.2f} seconds")
+                UPDATE_PROCESSING.observe(time.perf_counter() - start_time)
+                PROFILER.count_update()
+                logger.info(
+                    "Processed update in %.2f seconds (waited %.2f seconds in queue)",
+                    time.perf_counter() - start_time, start_time - queued_at, extra=LOG_SAMPLED
+                )
             else:
                 logger.warning("Received invalid update data")
-            update_queue.task_done()
-        except queue.Empty:
-            await asyncio.sleep(0.1)
         except Exception as e:
+            error = type(e).__name__
             logger.error(f"Error processing queued update: {e}", exc_info=True)
-            await asyncio.sleep(1)
+        finally:
+            CURRENT_TRACE.reset(token)
+            if trace is not None:
+                trace.finish(error)
+            update_queue.task_done()
+
+# کش عضویت کانال با TTL مثبت/منفی و ادغام درخواست‌های هم‌زمان
+class MembershipCache:
+    def __init__(self, ttl=MEMBERSHIP_TTL, negative_ttl=MEMBERSHIP_NEGATIVE_TTL, max_entries=MEMBERSHIP_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    async def is_member(self, bot, user_id):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            is_member, expires_at = entry
+            if time.monotonic() < expires_at:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return is_member
+            del self._entries[user_id]
+        future = self._inflight.get(user_id)
+        if future is not None:
+            self.hits += 1
+            return await asyncio.shield(future)
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[user_id] = future
+        try:
+            chat_member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
+            is_member = chat_member.status in ['member', 'administrator', 'creator']
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # جلوگیری از هشدار exception بازیابی‌نشده
+            raise
+        else:
+            self._store(user_id, is_member)
+            future.set_result(is_member)
+            return is_member
+        finally:
+            self._inflight.pop(user_id, None)
+
+    def _store(self, user_id, is_member):
+        ttl = self.ttl if is_member else self.negative_ttl
+        self._entries[user_id] = (is_member, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+MEMBERSHIP_CACHE = MembershipCache()
 
 # بررسی عضویت
 async def check_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    logger.debug(f"Checking membership for user {user_id} in channel {CHANNEL_ID}")
+    logger.debug("Checking membership for user %s in channel %s", user_id, CHANNEL_ID)
     try:
-        chat_member = await context.bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        if chat_member.status in ['member', 'administrator', 'creator']:
-            logger.debug(f"User {user_id} is a member of channel {CHANNEL_ID}")
+        if await MEMBERSHIP_CACHE.is_member(context.bot, user_id):
+            logger.debug("User %s is a member of channel %s", user_id, CHANNEL_ID)
             return True
         else:
-            logger.debug(f"User {user_id} is not a member of channel {CHANNEL_ID}")
+            logger.debug("User %s is not a member of channel %s", user_id, CHANNEL_ID)
             return False
     except TelegramError as e:
         logger.error(f"Error checking membership for user {user_id}: {e}", exc_info=True)
         if isinstance(e, Forbidden):
-            logger.warning(f"Bot does not have permission to check membership in {CHANNEL_ID}")
+            logger.warning("Bot does not have permission to check membership in %s", CHANNEL_ID)
         await update.effective_message.reply_text(
             "❌ خطایی در بررسی عضویت رخ داد. لطفاً مطمئن شوید که در کانال عضو هستید و دوباره تلاش کنید."
         )
@@ -317,14 +1871,16 @@ async def check_membership(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # دستور start
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logger.debug(f"Start command received from user {update.effective_user.id}")
+    logger.debug("Start command received from user %s", update.effective_user.id)
     user = update.effective_user
     if await check_membership(update, context):
         buttons = [
             [InlineKeyboardButton("➕ ثبت آگهی", callback_data="post_ad")],
             [InlineKeyboardButton("📜 ثبت حواله", callback_data="post_referral")],
             [InlineKeyboardButton("🗂️ نمایش آگهی‌ها", callback_data="show_ads_ad")],
-            [InlineKeyboardButton("📋 نمایش حواله‌ها", callback_data="show_ads_referral")]
+            [InlineKeyboardButton("📋 نمایش حواله‌ها", callback_data="show_ads_referral")],
+            [InlineKeyboardButton("🔍 جست‌وجو", callback_data="search")],
+            [InlineKeyboardButton("🎯 فیلتر آگهی‌ها", callback_data=filter_callback_data("flt", AdFilter()))]
         ]
         if user.id in ADMIN_ID:
             buttons.extend([
@@ -346,13 +1902,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             parse_mode="Markdown"
         )
         try:
-            with get_db_connection() as conn:
-                conn.execute(
-                    'INSERT OR REPLACE INTO users (user_id, joined) VALUES (?, ?)',
-                    (user.id, datetime.now().isoformat())
-                )
-                conn.commit()
-                logger.debug(f"User {user.id} registered in database")
+            await DB.write(
+                'INSERT OR REPLACE INTO users (user_id, joined) VALUES (?, ?)',
+                (user.id, datetime.now().isoformat())
+            )
+            logger.debug("User %s registered in database", user.id)
         except sqlite3.Error as e:
             logger.error(f"Database error in start: {e}")
             await update.effective_message.reply_text("❌ خطایی در ثبت اطلاعات رخ داد.")
@@ -369,17 +1923,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # دستور cancel
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    with FSM_LOCK:
-        if user_id in FSM_STATES:
-            del FSM_STATES[user_id]
-            await update.message.reply_text("فرآیند لغو شد. برای شروع دوباره، /start را بزنید.")
-        else:
-            await update.message.reply_text("هیچ فرآیند فعالی وجود ندارد.")
+    if await FSM_STORE.clear(user_id):
+        await update.message.reply_text("فرآیند لغو شد. برای شروع دوباره، /start را بزنید.")
+    else:
+        await update.message.reply_text("هیچ فرآیند فعالی وجود ندارد.")
 
 # دستور admin
 async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    logger.debug(f"Admin command received from user {user_id}")
+    logger.debug("Admin command received from user %s", user_id)
     if user_id in ADMIN_ID:
         buttons = [
             [InlineKeyboardButton("📋 بررسی آگهی‌ها", callback_data="review_ads_ad")],
@@ -392,332 +1944,485 @@ async def admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
             reply_markup=InlineKeyboardMarkup(buttons)
         )
     else:
-        logger.debug(f"User {user_id} is not an admin")
+        logger.debug("User %s is not an admin", user_id)
         await update.effective_message.reply_text("⚠️ شما دسترسی ادمین ندارید.")
 
 # دستور stats
 async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
-    logger.debug(f"Stats command received from user {user_id}")
+    logger.debug("Stats command received from user %s", user_id)
     if user_id in ADMIN_ID:
         try:
-            with get_db_connection() as conn:
-                user_count = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-                ad_count = conn.execute("SELECT COUNT(*) FROM ads WHERE status = 'approved'").fetchone()[0]
+            user_count, ad_count = await DB.run(lambda conn: (
+                conn.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+                conn.execute("SELECT COUNT(*) FROM ads WHERE status = 'approved'").fetchone()[0]
+            ), op="stats")
             stats_text = (
                 f"📊 آمار ربات:\n"
                 f"تعداد کاربران: {user_count}\n"
-                f"تعداد آگهی‌های تأییدشده: {ad_count}"
+                f"تعداد آگهی‌های تأییدشده: {ad_count}\n"
+                f"آپدیت‌های پذیرفته‌شده: {INGRESS_STATS['accepted']}\n"
+                f"آپدیت‌های کنارگذاشته‌شده: {INGRESS_STATS['shed']}\n"
+                f"آپدیت‌های ارجاع‌شده برای ارسال مجدد: {INGRESS_STATS['redelivered']}\n"
+                f"آپدیت‌های در صف: {update_queue_size()}"
             )
             await update.effective_message.reply_text(stats_text)
         except sqlite3.Error as e:
             logger.error(f"Database error in stats: {e}")
             await update.effective_message.reply_text("❌ خطایی در دریافت آمار رخ داد.")
     else:
-        logger.debug(f"User {user_id} is not an admin")
+        logger.debug("User %s is not an admin", user_id)
+        await update.effective_message.reply_text("⚠️ شما دسترسی ادمین ندارید.")
+
+# دستور checkindex: بررسی سازگاری ایندکس آگهی‌ها با دیتابیس
+async def check_index(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_ID:
+        await update.effective_message.reply_text("⚠️ شما دسترسی ادمین ندارید.")
+        return
+    rows = await DB.fetchall(APPROVED_ADS_QUERY)
+    problems = APPROVED_INDEX.verify(rows)
+    if problems:
+        logger.warning("Approved ads index inconsistent: %s", problems[:20])
+        APPROVED_INDEX.build(rows)
+        await update.effective_message.reply_text(
+            f"⚠️ {len(problems)} مغایرت در ایندکس آگهی‌ها پیدا شد و ایندکس بازسازی شد:\n" + "\n".join(problems[:10])
+        )
+    else:
+        await update.effective_message.reply_text(f"✅ ایندکس آگهی‌ها با دیتابیس سازگار است ({len(rows)} آگهی).")
+
+# پروفایلر نمونه‌بردار: نخ جداگانه هر PROFILE_INTERVAL پشته نخ حلقه رویداد را برمی‌دارد
+class SamplingProfiler:
+    TOP_FUNCTIONS = 15
+
+    def __init__(self):
+        self._thread = None
+        self._target = None
+        self._stop = threading.Event()
+        self.report_task = None
+        self.stacks = {}
+        self.samples = 0
+        self.updates = 0
+        self.max_updates = 0
+        self.seconds = 0
+        self.started_at = 0
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, seconds, max_updates=0):
+        if self.running:
+            raise RuntimeError("profiler is already running")
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self.stacks = {}
+        self.samples = 0
+        self.updates = 0
+        self.max_updates = max_updates
+        self.seconds = seconds
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self):
+        if self._thread is not None:
+            self._thread.join()
+
+    def count_update(self):
+        if self.running:
+            self.updates += 1
+
+    def _run(self):
+        deadline = self.started_at + self.seconds
+        while not self._stop.wait(PROFILE_INTERVAL):
+            if time.monotonic() >= deadline or (self.max_updates and self.updates >= self.max_updates):
+                break
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                self._sample(frame)
+
+    # پشته از ریشه به برگ و هندلری که فریم wrapper در instrument_handler نشان می‌دهد
+    def _sample(self, frame):
+        codes = []
+        handler = None
+        while frame is not None:
+            codes.append(frame.f_code)
+            if handler is None and frame.f_code is INSTRUMENTED_HANDLER_CODE:
+                handler = frame.f_locals.get("handler")
+            frame = frame.f_back
+        if handler is None:
+            handler = "(idle)" if codes[0].co_name == "select" else "(other)"
+        key = (handler, tuple(reversed(codes)))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+        self.samples += 1
+
+    # co_qualname فقط از پایتون 3.11 وجود دارد
+    @staticmethod
+    def frame_name(code):
+        return f"{getattr(code, 'co_qualname', code.co_name)} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    # نوشتن پشته‌های فشرده (قابل استفاده با flamegraph.pl یا speedscope) و خلاصه به تفکیک هندلر
+    def write(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        collapsed_path = os.path.join(directory, f"profile-{stamp}.collapsed")
+        summary_path = os.path.join(directory, f"profile-{stamp}.txt")
+        by_handler = {}
+        self_time = {}
+        with open(collapsed_path, "w", encoding="utf-8") as f:
+            for (handler, codes), count in sorted(self.stacks.items(), key=lambda item: -item[1]):
+                f.write(";".join([handler] + [self.frame_name(code) for code in codes]) + f" {count}\n")
+                by_handler[handler] = by_handler.get(handler, 0) + count
+                functions = self_time.setdefault(handler, {})
+                functions[codes[-1]] = functions.get(codes[-1], 0) + count
+        elapsed = time.monotonic() - self.started_at
+        total = max(self.samples, 1)
+        lines = [
+            f"samples: {self.samples} every {PROFILE_INTERVAL * 1000:.0f} ms over {elapsed:.1f} s, "
+            f"{self.updates} updates",
+            "",
+            "samples by handler (idle = event loop waiting for I/O):",
+        ]
+        for handler, count in sorted(by_handler.items(), key=lambda item: -item[1]):
+            lines.append(f"  {count:>7} {count / total:6.1%}  {handler}")
+        for handler, count in sorted(by_handler.items(), key=lambda item: -item[1]):
+            if handler == "(idle)":
+                continue
+            lines += ["", f"top functions (self) in {handler}:"]
+            functions = sorted(self_time[handler].items(), key=lambda item: -item[1])[:self.TOP_FUNCTIONS]
+            for code, samples in functions:
+                lines.append(f"  {samples:>7} {samples / count:6.1%}  {self.frame_name(code)}")
+        with open(summary_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        return summary_path, collapsed_path, lines
+
+PROFILER = SamplingProfiler()
+PROFILE_SPEC_RE = re.compile(r"^(\d+(?:\.\d+)?)\s*([su]?)$")
+
+# تبدیل "60" / "60s" به مدت و "500u" به تعداد آپدیت
+def parse_profile_spec(text):
+    match = PROFILE_SPEC_RE.match(text.strip().lower())
+    if not match:
+        return None
+    value, unit = match.groups()
+    if unit == "u":
+        return PROFILE_MAX_SECONDS, max(1, int(float(value)))
+    return min(float(value), PROFILE_MAX_SECONDS), 0
+
+# شروع پروفایلر؛ نتیجه پس از پایان برای ادمین‌ها ارسال می‌شود
+def start_profile(bot, chat_ids, seconds, max_updates):
+    PROFILER.start(seconds, max_updates)
+    logger.info("Profiler started for %ss / %s updates", seconds, max_updates or "any")
+    PROFILER.report_task = asyncio.create_task(send_profile(bot, chat_ids))
+
+async def send_profile(bot, chat_ids):
+    await asyncio.to_thread(PROFILER.join)
+    summary_path, collapsed_path, lines = await asyncio.to_thread(PROFILER.write, PROFILE_DIR)
+    logger.info("Profile written to %s (%s samples)", summary_path, PROFILER.samples)
+    for chat_id in chat_ids:
+        try:
+            for path in (summary_path, collapsed_path):
+                with open(path, "rb") as f:
+                    await bot.send_document(
+                        chat_id=chat_id, document=f, filename=os.path.basename(path),
+                        caption="\n".join(lines[:1]) if path == summary_path else None,
+                        rate_limit_args=PRIORITY_ADMIN
+                    )
+        except TelegramError as e:
+            logger.error(f"Cannot send profile to {chat_id}: {e}")
+
+# دستور profile: /profile [ثانیه | تعداد آپدیت با u | stop]
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_ID:
         await update.effective_message.reply_text("⚠️ شما دسترسی ادمین ندارید.")
+        return
+    arg = " ".join(context.args or ())
+    if PROFILER.running:
+        if arg == "stop":
+            PROFILER.stop()
+            await update.effective_message.reply_text("⏹ پروفایلر متوقف شد؛ نتیجه به‌زودی ارسال می‌شود.")
+        else:
+            await update.effective_message.reply_text(
+                f"⏳ پروفایلر در حال اجراست: {time.monotonic() - PROFILER.started_at:.0f} ثانیه، "
+                f"{PROFILER.samples} نمونه، {PROFILER.updates} آپدیت.\nبرای توقف: /profile stop"
+            )
+        return
+    spec = parse_profile_spec(arg) if arg else (PROFILE_DEFAULT_SECONDS, 0)
+    if spec is None:
+        await update.effective_message.reply_text(
+            "استفاده: /profile [ثانیه] یا /profile 500u (تعداد آپدیت) یا /profile stop"
+        )
+        return
+    seconds, max_updates = spec
+    start_profile(context.bot, [update.effective_chat.id], seconds, max_updates)
+    limit = f"{max_updates} آپدیت" if max_updates else f"{seconds:.0f} ثانیه"
+    await update.effective_message.reply_text(f"▶️ پروفایلر برای {limit} شروع شد.")
+
+# الگوها و کیبوردهای آماده فرم ثبت آگهی/حواله
+PHONE_CLEAN_RE = re.compile(r"\s+|-")
+PHONE_RE = re.compile(r"^(09|\+98|98)\d{9,10}$")
+PHONE_PROMPT = "لطفاً شماره تماس خود را با استفاده از دکمه زیر یا تایپ دستی (با فرمت 09xxxxxxxxx یا +98xxxxxxxxxx) ارسال کنید:"
+CONTACT_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton("📞 ارسال شماره تماس", request_contact=True)]],
+    one_time_keyboard=True,
+    resize_keyboard=True
+)
+EMPTY_KEYBOARD = ReplyKeyboardMarkup([], resize_keyboard=True)
+MAX_AD_IMAGES = 5
+
+# خطای اعتبارسنجی یک مرحله که متنش به کاربر برگردانده می‌شود
+class StepError(Exception):
+    def __init__(self, text, reply_markup=None):
+        super().__init__(text)
+        self.text = text
+        self.reply_markup = reply_markup
+
+# اعتبارسنج‌های مراحل
+def parse_text(message):
+    if not message.text:
+        raise StepError("لطفاً پاسخ را به صورت متن ارسال کنید:")
+    return message.text
+
+def parse_price(message):
+    try:
+        return int(message.text)
+    except (TypeError, ValueError):
+        raise StepError("لطفاً فقط عدد وارد کنید:")
+
+def parse_phone(message):
+    if message.contact:
+        phone_number = message.contact.phone_number
+    elif message.text:
+        phone_number = message.text.strip()
+    else:
+        raise StepError(PHONE_PROMPT, CONTACT_KEYBOARD)
+    cleaned_phone = PHONE_CLEAN_RE.sub("", phone_number)
+    if not PHONE_RE.match(cleaned_phone):
+        raise StepError(
+            "⚠️ شماره تلفن باید با 09 یا +98 شروع شود و 11 یا 12 رقم باشد. لطفاً دوباره روی دکمه کلیک کنید یا شماره را تایپ کنید:"
+        )
+    return cleaned_phone
+
+# تعریف یک مرحله از فرم
+class WizardStep:
+    __slots__ = ("field", "state_name", "prompt", "parse", "reply_markup", "parse_mode",
+                 "initial", "on_message", "state", "next", "finish")
+
+    def __init__(self, field, prompt, parse=parse_text, reply_markup=None, parse_mode=None,
+                 initial=None, on_message=None, state_name=None):
+        self.field = field
+        self.state_name = state_name or field
+        self.prompt = prompt
+        self.parse = parse
+        self.reply_markup = reply_markup
+        self.parse_mode = parse_mode
+        self.initial = initial or {}
+        self.on_message = on_message
+        self.state = None
+        self.next = None
+        self.finish = None
+
+    async def ask(self, message):
+        await message.reply_text(self.prompt, reply_markup=self.reply_markup, parse_mode=self.parse_mode)
+
+# جدول مراحل بر اساس نام وضعیت
+WIZARD_STEPS = {}
+WIZARD_FIRST_STEP = {}
+
+# ثبت یک نوع آیتم جدید در موتور فرم
+def register_wizard(ad_type, steps, finish):
+    for i, step in enumerate(steps):
+        step.state = f"post_{ad_type}_{step.state_name}"
+        step.next = steps[i + 1] if i + 1 < len(steps) else None
+        step.finish = finish
+        WIZARD_STEPS[step.state] = step
+    WIZARD_FIRST_STEP[ad_type] = steps[0]
+
+# شروع فرم برای یک نوع آیتم
+async def start_wizard(update: Update, ad_type):
+    user_id = update.effective_user.id
+    logger.debug("Wizard %s started for user %s", ad_type, user_id)
+    step = WIZARD_FIRST_STEP[ad_type]
+    await FSM_STORE.set(user_id, dict(step.initial, state=step.state))
+    await step.ask(update.effective_message)
 
 # شروع ثبت آگهی
 async def post_ad_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    logger.debug(f"Post ad started for user {user_id}")
-    with FSM_LOCK:
-        FSM_STATES[user_id] = {"state": "post_ad_title"}
-    await update.effective_message.reply_text("لطفاً برند و مدل خودروی خود را وارد نمایید.(مثلاً: فروش پژو207 پانا):")
+    await start_wizard(update, "ad")
 
 # شروع ثبت حواله
 async def post_referral_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.effective_user.id
-    logger.debug(f"Post referral started for user {user_id}")
-    with FSM_LOCK:
-        FSM_STATES[user_id] = {"state": "post_referral_title"}
-    await update.effective_message.reply_text("لطفاً عنوان حواله را وارد کنید (مثال: حواله پژو 207):")
+    await start_wizard(update, "referral")
 
-# مدیریت پیام‌های آگهی
-async def post_ad_handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+# اجرای یک مرحله از فرم برای پیام دریافتی
+async def handle_wizard_message(update: Update, context: ContextTypes.DEFAULT_TYPE, step, draft):
     user_id = update.effective_user.id
-    message = update.effective_message
-    state = FSM_STATES.get(user_id, {}).get("state")
-
-    logger.debug(f"Handling message for user {user_id} in state {state}")
-
+    message = update.message
+    started = time.perf_counter()
     try:
-        if state == "post_ad_title":
-            with FSM_LOCK:
-                FSM_STATES[user_id]["title"] = message.text
-                FSM_STATES[user_id]["state"] = "post_ad_description"
-            await update.message.reply_text(
-                "لطفا *اطلاعات خودرو* شامل رنگ، کارکرد، وضعیت بدنه، وضعیت فنی و غیره را وارد نمایید.",
-                parse_mode="Markdown"
-            )
-        elif state == "post_ad_description":
-            with FSM_LOCK:
-                FSM_STATES[user_id]["description"] = message.text
-                FSM_STATES[user_id]["state"] = "post_ad_price"
-            await update.message.reply_text(
-                "*لطفاً قیمت آگهی را به تومان وارد کنید* (فقط عدد):",
-                parse_mode="Markdown"
-            )
-        elif state == "post_ad_price":
-            try:
-                price = int(message.text)
-                with FSM_LOCK:
-                    FSM_STATES[user_id]["price"] = price
-                    FSM_STATES[user_id]["state"] = "post_ad_phone"
-                keyboard = ReplyKeyboardMarkup(
-                    [[KeyboardButton("📞 ارسال شماره تماس", request_contact=True)]],
-                    one_time_keyboard=True,
-                    resize_keyboard=True
-                )
-                await update.message.reply_text(
-                    "لطفاً شماره تماس خود را با استفاده از دکمه زیر یا تایپ دستی (با فرمت 09xxxxxxxxx یا +98xxxxxxxxxx) ارسال کنید:",
-                    reply_markup=keyboard
-                )
-            except ValueError:
-                await update.message.reply_text("لطفاً فقط عدد وارد کنید:")
-        elif state == "post_ad_phone":
-            phone_number = None
-            if message.contact:
-                phone_number = message.contact.phone_number
-            elif message.text:
-                phone_number = message.text.strip()
-            
-            if phone_number:
-                cleaned_phone = re.sub(r"\s+|-", "", phone_number)
-                logger.debug(f"Received phone number: {phone_number}, cleaned: {cleaned_phone}")
-                if re.match(r"^(09|\+98|98)\d{9,10}$", cleaned_phone):
-                    with FSM_LOCK:
-                        FSM_STATES[user_id]["phone"] = cleaned_phone
-                        FSM_STATES[user_id]["state"] = "post_ad_image"
-                        FSM_STATES[user_id]["images"] = []
-                    await update.message.reply_text(
-                        "اکنون لطفاً تصاویر واضح از خودرو ارسال نمایید (حداکثر 5 عدد). پس از ارسال همه عکس‌ها، /done را بزنید.",
-                        reply_markup=ReplyKeyboardMarkup([], resize_keyboard=True)
-                    )
-                else:
-                    await update.message.reply_text(
-                        "⚠️ شماره تلفن باید با 09 یا +98 شروع شود و 11 یا 12 رقم باشد. لطفاً دوباره روی دکمه کلیک کنید یا شماره را تایپ کنید:"
-                    )
-            else:
-                await update.message.reply_text(
-                    "لطفاً شماره تماس خود را با استفاده از دکمه زیر یا تایپ دستی (با فرمت 09xxxxxxxxx یا +98xxxxxxxxxx) ارسال کنید:",
-                    reply_markup=ReplyKeyboardMarkup(
-                        [[KeyboardButton("📞 ارسال شماره تماس", request_contact=True)]],
-                        one_time_keyboard=True,
-                        resize_keyboard=True
-                    )
-                )
-        elif state == "post_ad_image":
-            if message.text == "/done":
-                if not FSM_STATES[user_id].get("images"):
-                    await message.reply_text(
-                        "شما هیچ عکسی آپلود نکردید. لطفاً حداقل یک عکس ارسال کنید یا /cancel بزنید."
-                    )
-                    return
-                try:
-                    with get_db_connection() as conn:
-                        cursor = conn.cursor()
-                        cursor.execute(
-                            """
-                            INSERT INTO ads (user_id, type, title, description, price, image_id, phone, status)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                            """,
-                            (
-                                user_id,
-                                "ad",
-                                FSM_STATES[user_id]["title"],
-                                FSM_STATES[user_id]["description"],
-                                FSM_STATES[user_id]["price"],
-                                json.dumps(FSM_STATES[user_id]["images"]),
-                                FSM_STATES[user_id]["phone"],
-                                "pending",
-                            ),
-                        )
-                        ad_id = cursor.lastrowid
-                        conn.commit()
-                        logger.debug(
-                            f"Ad saved for user {user_id} with id {ad_id} and {len(FSM_STATES[user_id]['images'])} images"
-                        )
-
-                    await message.reply_text(
-                        "✅ آگهی شما با موفقیت ثبت شد و در انتظار تأیید ادمین است."
-                    )
-
-                    username = update.effective_user.username or "بدون نام کاربری"
-                    ad_text = (
-                        f"🚗 آگهی جدید از کاربر {user_id}:\n"
-                        f"نام کاربری: @{username}\n"
-                        f"شماره تماس: {FSM_STATES[user_id]['phone']}\n"
-                        f"عنوان: {FSM_STATES[user_id]['title']}\n"
-                        f"توضیحات: {FSM_STATES[user_id]['description']}\n"
-                        f"💰 قیمت: {FSM_STATES[user_id]['price']:,} تومان\n"
-                        f"تعداد عکس‌ها: {len(FSM_STATES[user_id]['images'])}"
-                    )
-                    buttons = [
-                        [InlineKeyboardButton("✅ تأیید", callback_data=f"approve_ad_{ad_id}")],
-                        [InlineKeyboardButton("❌ رد", callback_data=f"reject_ad_{ad_id}")]
-                    ]
-                    for admin_id in ADMIN_ID:
-                        try:
-                            if FSM_STATES[user_id]["images"]:
-                                media = [
-                                    InputMediaPhoto(media=photo, caption=ad_text if i == 0 else None)
-                                    for i, photo in enumerate(FSM_STATES[user_id]["images"])
-                                ]
-                                await context.bot.send_media_group(
-                                    chat_id=admin_id,
-                                    media=media
-                                )
-                                await context.bot.send_message(
-                                    chat_id=admin_id,
-                                    text="لطفاً آگهی را تأیید یا رد کنید:",
-                                    reply_markup=InlineKeyboardMarkup(buttons)
-                                )
-                            else:
-                                await context.bot.send_message(
-                                    chat_id=admin_id,
-                                    text=ad_text,
-                                    reply_markup=InlineKeyboardMarkup(buttons)
-                                )
-                        except Exception as e:
-                            logger.error(f"Error notifying admin {admin_id} for ad {ad_id}: {e}")
-                            await context.bot.send_message(
-                                chat_id=admin_id,
-                                text=f"خطا در ارسال آگهی: {ad_text}",
-                                reply_markup=InlineKeyboardMarkup(buttons)
-                            )
-                    with FSM_LOCK:
-                        FSM_STATES[user_id] = {}
-                    backup_db()  # بکاپ‌گیری بعد از ثبت آگهی
-                    return
-                except Exception as e:
-                    logger.error(f"Error saving ad for user {user_id}: {e}", exc_info=True)
-                    await message.reply_text("❌ خطایی در ثبت آگهی رخ داد. لطفاً دوباره امتحان کنید.")
-                    return
-            elif message.photo:
-                if len(FSM_STATES[user_id]["images"]) >= 5:
-                    await message.reply_text("شما حداکثر 5 عکس می‌توانید ارسال کنید. لطفاً /done بزنید.")
-                    return
-                photo = message.photo[-1].file_id
-                FSM_STATES[user_id]["images"].append(photo)
-                await message.reply_text(f"عکس {len(FSM_STATES[user_id]['images'])} دریافت شد. عکس بعدی یا /done")
-                return
-            else:
-                await message.reply_text(
-                    "لطفاً فقط عکس ارسال کنید یا برای اتمام /done را بزنید."
-                )
-                return
+        if step.on_message:
+            await step.on_message(update, context, step, draft)
+            return
+        try:
+            value = step.parse(message)
+        except StepError as e:
+            await message.reply_text(e.text, reply_markup=e.reply_markup)
+            return
+        if step.next:
+            await FSM_STORE.update(user_id, **step.next.initial, **{step.field: value, "state": step.next.state})
+            await step.next.ask(message)
+        else:
+            draft = await FSM_STORE.update(user_id, **{step.field: value})
+            await step.finish(update, context, draft)
     except Exception as e:
-        logger.error(f"Error in post_ad_handle_message for user {user_id}: {e}", exc_info=True)
+        logger.error(f"Error in wizard step {step.state} for user {user_id}: {e}", exc_info=True)
+        HANDLER_ERRORS.inc((f"wizard:{step.state}",))
         await message.reply_text("❌ خطایی رخ داد. لطفاً دوباره امتحان کنید.")
-
-# مدیریت پیام‌های حواله
-async def post_referral_handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    finally:
+        HANDLER_LATENCY.observe(time.perf_counter() - started, (f"wizard:{step.state}",))
+        trace = CURRENT_TRACE.get()
+        if trace is not None:
+            trace.add("wizard", started, step=step.state)
+
+# جمع‌آوری عکس‌های آگهی تا زدن /done
+async def collect_ad_images(update: Update, context: ContextTypes.DEFAULT_TYPE, step, draft):
     user_id = update.effective_user.id
-    logger.debug(f"Entering post_referral_handle_message for user {user_id}")
-    
-    with FSM_LOCK:
-        if user_id not in FSM_STATES or "state" not in FSM_STATES[user_id]:
-            logger.debug(f"No FSM state for user {user_id}, ignoring message")
-            try:
-                await update.message.reply_text("⚠️ لطفاً فرآیند ثبت حواله را از ابتدا شروع کنید (/start).")
-            except Exception as e:
-                logger.error(f"Failed to send invalid state message to user {user_id}: {e}", exc_info=True)
+    message = update.message
+    if message.text == "/done":
+        if not draft.get("images"):
+            await message.reply_text(
+                "شما هیچ عکسی آپلود نکردید. لطفاً حداقل یک عکس ارسال کنید یا /cancel بزنید."
+            )
             return
-        state = FSM_STATES[user_id]["state"]
-    
+        await step.finish(update, context, draft)
+    elif message.photo:
+        async with FSM_STORE.edit(user_id) as state_data:
+            images = state_data.setdefault("images", [])
+            accepted = len(images) < MAX_AD_IMAGES
+            if accepted:
+                images.append(message.photo[-1].file_id)
+            count = len(images)
+        if not accepted:
+            await message.reply_text("شما حداکثر 5 عکس می‌توانید ارسال کنید. لطفاً /done بزنید.")
+            return
+        await message.reply_text(f"عکس {count} دریافت شد. عکس بعدی یا /done")
+    else:
+        await message.reply_text(
+            "لطفاً فقط عکس ارسال کنید یا برای اتمام /done را بزنید."
+        )
+
+# ذخیره آگهی
+async def save_ad(update: Update, context: ContextTypes.DEFAULT_TYPE, draft):
+    user_id = update.effective_user.id
     message = update.message
-    logger.debug(f"Handling message for user {user_id} in state {state}")
-    
     try:
-        if state == "post_referral_title":
-            with FSM_LOCK:
-                FSM_STATES[user_id]["title"] = message.text
-                FSM_STATES[user_id]["state"] = "post_referral_description"
-            await update.message.reply_text("لطفاً توضیحات حواله را وارد کنید:")
-        elif state == "post_referral_description":
-            with FSM_LOCK:
-                FSM_STATES[user_id]["description"] = message.text
-                FSM_STATES[user_id]["state"] = "post_referral_price"
-            await update.message.reply_text("لطفاً قیمت حواله را به تومان وارد کنید (فقط عدد):")
-        elif state == "post_referral_price":
+        cursor = await DB.execute(
+            """
+            INSERT INTO ads (user_id, type, title, description, price, image_id, phone, status, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                user_id,
+                "ad",
+                draft["title"],
+                draft["description"],
+                draft["price"],
+                json.dumps(draft["images"]),
+                draft["phone"],
+                "pending",
+                datetime.now().isoformat(),
+            ),
+        )
+        ad_id = cursor.lastrowid
+        logger.debug("Ad saved for user %s with id %s and %s images", user_id, ad_id, len(draft['images']))
+
+        await message.reply_text(
+            "✅ آگهی شما با موفقیت ثبت شد و در انتظار تأیید ادمین است."
+        )
+
+        username = update.effective_user.username or "بدون نام کاربری"
+        ad_text = (
+            f"🚗 آگهی جدید از کاربر {user_id}:\n"
+            f"نام کاربری: @{username}\n"
+            f"شماره تماس: {draft['phone']}\n"
+            f"عنوان: {draft['title']}\n"
+            f"توضیحات: {draft['description']}\n"
+            f"💰 قیمت: {draft['price']:,} تومان\n"
+            f"تعداد عکس‌ها: {len(draft['images'])}"
+        )
+        buttons = [
+            [InlineKeyboardButton("✅ تأیید", callback_data=f"approve_ad_{ad_id}")],
+            [InlineKeyboardButton("❌ رد", callback_data=f"reject_ad_{ad_id}")]
+        ]
+        for admin_id in ADMIN_ID:
             try:
-                price = int(message.text)
-                with FSM_LOCK:
-                    FSM_STATES[user_id]["price"] = price
-                    FSM_STATES[user_id]["state"] = "post_referral_phone"
-                keyboard = ReplyKeyboardMarkup(
-                    [[KeyboardButton("📞 ارسال شماره تماس", request_contact=True)]],
-                    one_time_keyboard=True,
-                    resize_keyboard=True
-                )
-                await update.message.reply_text(
-                    "لطفاً شماره تماس خود را با استفاده از دکمه زیر یا تایپ دستی (با فرمت 09xxxxxxxxx یا +98xxxxxxxxxx) ارسال کنید:",
-                    reply_markup=keyboard
-                )
-            except ValueError:
-                await update.message.reply_text("لطفاً فقط عدد وارد کنید:")
-        elif state == "post_referral_phone":
-            phone_number = None
-            if message.contact:
-                phone_number = message.contact.phone_number
-            elif message.text:
-                phone_number = message.text.strip()
-            
-            if phone_number:
-                cleaned_phone = re.sub(r"\s+|-", "", phone_number)
-                logger.debug(f"Received phone number: {phone_number}, cleaned: {cleaned_phone}")
-                if re.match(r"^(09|\+98|98)\d{9,10}$", cleaned_phone):
-                    with FSM_LOCK:
-                        FSM_STATES[user_id]["phone"] = cleaned_phone
-                    await save_referral(update, context)
-                else:
-                    await update.message.reply_text(
-                        "⚠️ شماره تلفن باید با 09 یا +98 شروع شود و 11 یا 12 رقم باشد. لطفاً دوباره روی دکمه کلیک کنید یا شماره را تایپ کنید:"
+                if draft["images"]:
+                    media = [
+                        InputMediaPhoto(media=photo, caption=ad_text if i == 0 else None)
+                        for i, photo in enumerate(draft["images"])
+                    ]
+                    await context.bot.send_media_group(
+                        chat_id=admin_id,
+                        media=media,
+                        rate_limit_args=PRIORITY_ADMIN
                     )
-            else:
-                await update.message.reply_text(
-                    "لطفاً شماره تماس خود را با استفاده از دکمه زیر یا تایپ دستی (با فرمت 09xxxxxxxxx یا +98xxxxxxxxxx) ارسال کنید:",
-                    reply_markup=ReplyKeyboardMarkup(
-                        [[KeyboardButton("📞 ارسال شماره تماس", request_contact=True)]],
-                        one_time_keyboard=True,
-                        resize_keyboard=True
+                    await context.bot.send_message(
+                        chat_id=admin_id,
+                        text="لطفاً آگهی را تأیید یا رد کنید:",
+                        reply_markup=InlineKeyboardMarkup(buttons),
+                        rate_limit_args=PRIORITY_ADMIN
+                    )
+                else:
+                    await context.bot.send_message(
+                        chat_id=admin_id,
+                        text=ad_text,
+                        reply_markup=InlineKeyboardMarkup(buttons),
+                        rate_limit_args=PRIORITY_ADMIN
                     )
+            except Exception as e:
+                logger.error(f"Error notifying admin {admin_id} for ad {ad_id}: {e}")
+                await context.bot.send_message(
+                    chat_id=admin_id,
+                    text=f"خطا در ارسال آگهی: {ad_text}",
+                    reply_markup=InlineKeyboardMarkup(buttons),
+                    rate_limit_args=PRIORITY_ADMIN
                 )
+        await FSM_STORE.clear(user_id)
+        backup_db()  # بکاپ‌گیری بعد از ثبت آگهی
     except Exception as e:
-        logger.error(f"Error in post_referral_handle_message for user {user_id}: {e}", exc_info=True)
-        await update.message.reply_text("❌ خطایی در پردازش درخواست شما رخ داد.")
-        with FSM_LOCK:
-            if user_id in FSM_STATES:
-                del FSM_STATES[user_id]
+        logger.error(f"Error saving ad for user {user_id}: {e}", exc_info=True)
+        await message.reply_text("❌ خطایی در ثبت آگهی رخ داد. لطفاً دوباره امتحان کنید.")
 
 # ذخیره حواله
-async def save_referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def save_referral(update: Update, context: ContextTypes.DEFAULT_TYPE, draft):
     user_id = update.effective_user.id
-    logger.debug(f"Saving referral for user {user_id}")
+    logger.debug("Saving referral for user %s", user_id)
     try:
-        with get_db_connection() as conn:
-            cursor = conn.execute(
-                '''INSERT INTO ads (user_id, type, title, description, price, created_at, status, image_id, phone)
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                (
-                    user_id,
-                    "referral",
-                    FSM_STATES[user_id]["title"],
-                    FSM_STATES[user_id]["description"],
-                    FSM_STATES[user_id]["price"],
-                    datetime.now().isoformat(),
-                    "pending",
-                    None,
-                    FSM_STATES[user_id]["phone"],
-                ),
-            )
-            ad_id = cursor.lastrowid
-            conn.commit()
-        logger.debug(f"Referral saved successfully for user {user_id} with ad_id {ad_id}")
+        cursor = await DB.execute(
+            '''INSERT INTO ads (user_id, type, title, description, price, created_at, status, image_id, phone)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (
+                user_id,
+                "referral",
+                draft["title"],
+                draft["description"],
+                draft["price"],
+                datetime.now().isoformat(),
+                "pending",
+                None,
+                draft["phone"],
+            ),
+        )
+        ad_id = cursor.lastrowid
+        logger.debug("Referral saved successfully for user %s with ad_id %s", user_id, ad_id)
         await update.message.reply_text(
             "🌟 حواله شما ثبت شد و در انتظار تأیید ادمین است.\n*ممنون از اعتماد شما*",
-            reply_markup=ReplyKeyboardMarkup([], resize_keyboard=True)
+            reply_markup=EMPTY_KEYBOARD
         )
         username = update.effective_user.username or "بدون نام کاربری"
         for admin_id in ADMIN_ID:
@@ -728,144 +2433,629 @@ async def save_referral(update: Update, context: ContextTypes.DEFAULT_TYPE):
             ad_text = (
                 f"حواله جدید از کاربر {user_id}:\n"
                 f"نام کاربری: @{username}\n"
-                f"شماره تلفن: {FSM_STATES[user_id]['phone']}\n"
-                f"عنوان: {FSM_STATES[user_id]['title']}\n"
-                f"توضیحات: {FSM_STATES[user_id]['description']}\n"
-                f"قیمت: {FSM_STATES[user_id]['price']:,} تومان"
+                f"شماره تلفن: {draft['phone']}\n"
+                f"عنوان: {draft['title']}\n"
+                f"توضیحات: {draft['description']}\n"
+                f"قیمت: {draft['price']:,} تومان"
             )
             await context.bot.send_message(
                 chat_id=admin_id,
                 text=ad_text,
-                reply_markup=InlineKeyboardMarkup(buttons)
+                reply_markup=InlineKeyboardMarkup(buttons),
+                rate_limit_args=PRIORITY_ADMIN
             )
-            logger.debug(f"Sent referral notification to admin {admin_id}")
-            await asyncio.sleep(1)
-        with FSM_LOCK:
-            del FSM_STATES[user_id]
+            logger.debug("Sent referral notification to admin %s", admin_id)
+        await FSM_STORE.clear(user_id)
         backup_db()  # بکاپ‌گیری بعد از ثبت حواله
     except Exception as e:
         logger.error(f"Error in save_referral: {str(e)}", exc_info=True)
         await update.message.reply_text("❌ خطایی در ثبت حواله رخ داد.")
 
+# مراحل فرم آگهی و حواله
+register_wizard("ad", [
+    WizardStep("title", "لطفاً برند و مدل خودروی خود را وارد نمایید.(مثلاً: فروش پژو207 پانا):"),
+    WizardStep("description", "لطفا *اطلاعات خودرو* شامل رنگ، کارکرد، وضعیت بدنه، وضعیت فنی و غیره را وارد نمایید.",
+               parse_mode="Markdown"),
+    WizardStep("price", "*لطفاً قیمت آگهی را به تومان وارد کنید* (فقط عدد):", parse=parse_price,
+               parse_mode="Markdown"),
+    WizardStep("phone", PHONE_PROMPT, parse=parse_phone, reply_markup=CONTACT_KEYBOARD),
+    WizardStep("images", "اکنون لطفاً تصاویر واضح از خودرو ارسال نمایید (حداکثر 5 عدد). پس از ارسال همه عکس‌ها، /done را بزنید.",
+               reply_markup=EMPTY_KEYBOARD, initial={"images": []}, on_message=collect_ad_images,
+               state_name="image"),
+], save_ad)
+register_wizard("referral", [
+    WizardStep("title", "لطفاً عنوان حواله را وارد کنید (مثال: حواله پژو 207):"),
+    WizardStep("description", "لطفاً توضیحات حواله را وارد کنید:"),
+    WizardStep("price", "لطفاً قیمت حواله را به تومان وارد کنید (فقط عدد):", parse=parse_price),
+    WizardStep("phone", PHONE_PROMPT, parse=parse_phone, reply_markup=CONTACT_KEYBOARD),
+], save_referral)
+
+# رکورد فشرده یک آگهی تأییدشده در حافظه
+class ApprovedAd:
+    FIELDS = ("id", "user_id", "type", "title", "description", "price", "created_at", "image_id", "phone")
+    __slots__ = FIELDS + ("search_text",)
+
+    def __init__(self, row):
+        for field in self.FIELDS:
+            setattr(self, field, row[field])
+        self.search_text = normalize_fa(f"{self.title or ''} {self.description or ''}")
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    @property
+    def sort_key(self):
+        return (self.created_at or "", self.id)
+
+# ایندکس مرتب آگهی‌های تأییدشده به تفکیک نوع (None = همه انواع)
+class ApprovedAdsIndex:
+    def __init__(self):
+        self._keys = {}
+        self._ads = {}
+        self._by_id = {}
+        self.version = 0  # با هر تغییر زیاد می‌شود تا کش‌های وابسته باطل شوند
+
+    def build(self, rows):
+        self.version += 1
+        self._keys.clear()
+        self._ads.clear()
+        self._by_id.clear()
+        for ad in sorted((ApprovedAd(row) for row in rows), key=lambda ad: ad.sort_key):
+            self._by_id[ad.id] = ad
+            for key in (ad.type, None):
+                self._keys.setdefault(key, []).append(ad.sort_key)
+                self._ads.setdefault(key, []).append(ad)
+
+    def add(self, row):
+        self.remove(row['id'])
+        self.version += 1
+        ad = ApprovedAd(row)
+        self._by_id[ad.id] = ad
+        for key in (ad.type, None):
+            keys = self._keys.setdefault(key, [])
+            position = bisect.bisect_left(keys, ad.sort_key)
+            keys.insert(position, ad.sort_key)
+            self._ads.setdefault(key, []).insert(position, ad)
+
+    def remove(self, ad_id):
+        ad = self._by_id.pop(ad_id, None)
+        if ad is None:
+            return
+        self.version += 1
+        for key in (ad.type, None):
+            position = bisect.bisect_left(self._keys[key], ad.sort_key)
+            del self._keys[key][position]
+            del self._ads[key][position]
+
+    def get(self, ad_id):
+        return self._by_id.get(ad_id)
+
+    def count(self, ad_type=None):
+        return len(self._keys.get(ad_type, ()))
+
+    # یک صفحه به ترتیب جدیدترین اول؛ cursor کلید (created_at, id) مرز صفحه قبلی است
+    def page(self, ad_type, cursor=None, direction="n", size=PAGE_SIZE):
+        keys = self._keys.get(ad_type, [])
+        ads = self._ads.get(ad_type, [])
+        if direction == "p" and cursor is not None:
+            start = bisect.bisect_right(keys, cursor)
+            end = min(start + size, len(ads))
+            has_more = end < len(ads)
+        else:
+            end = len(ads) if cursor is None else bisect.bisect_left(keys, cursor)
+            start = max(0, end - size)
+            has_more = start > 0
+        return ads[start:end][::-1], has_more
+
+    # آگهی‌هایی که همه کلمات را دارند، جدیدترین اول
+    def search(self, terms):
+        for ad in reversed(self._ads.get(None, [])):
+            if all(term in ad.search_text for term in terms):
+                yield ad
+
+    # مقایسه ایندکس با جدول ads
+    def verify(self, rows):
+        problems = []
+        expected = {row['id']: ApprovedAd(row) for row in rows}
+        for ad_id in expected.keys() - self._by_id.keys():
+            problems.append(f"missing ad {ad_id}")
+        for ad_id in self._by_id.keys() - expected.keys():
+            problems.append(f"stale ad {ad_id}")
+        for ad_id in expected.keys() & self._by_id.keys():
+            if any(getattr(expected[ad_id], f) != getattr(self._by_id[ad_id], f) for f in ApprovedAd.FIELDS):
+                problems.append(f"outdated ad {ad_id}")
+        for key, keys in self._keys.items():
+            if keys != sorted(keys) or len(keys) != len(self._ads[key]):
+                problems.append(f"unordered list for type {key}")
+        return problems
+
+APPROVED_INDEX = ApprovedAdsIndex()
+APPROVED_ADS_QUERY = (
+    "SELECT id, user_id, type, title, description, price, created_at, image_id, phone "
+    "FROM ads WHERE status = 'approved'"
+)
+
+# ساخت ایندکس آگهی‌های تأییدشده هنگام راه‌اندازی
+def load_approved_index():
+    rows = DB.run_sync(lambda conn: conn.execute(APPROVED_ADS_QUERY).fetchall())
+    APPROVED_INDEX.build(rows)
+    logger.debug("Approved ads index built with %s ads", APPROVED_INDEX.count())
+
+# کش LRU نتایج حالت inline بر اساس (عبارت، offset) و نسخه ایندکس
+class InlineResultCache:
+    def __init__(self, max_entries=INLINE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        entry = self._entries.get(key)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, version, value):
+        self._entries[key] = (version, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+INLINE_CACHE = InlineResultCache()
+
+# نتیجه inline برای یک آگهی (عکس ذخیره‌شده یا متن)
+def inline_result(ad):
+    rendered = RENDER_CACHE.get(ad, "listing")
+    title = f"{translate_ad_type(ad.type)}: {ad.title}"
+    description = f"💰 {ad.price:,} تومان"
+    if rendered.images:
+        return InlineQueryResultCachedPhoto(
+            id=str(ad.id), photo_file_id=rendered.images[0], title=title,
+            description=description, caption=rendered.text[:1024]
+        )
+    return InlineQueryResultArticle(
+        id=str(ad.id), title=title, description=description,
+        input_message_content=InputTextMessageContent(rendered.text[:4096])
+    )
+
+# یک صفحه از نتایج inline؛ بدون دیتابیس و از روی ایندکس حافظه
+def inline_page(text, offset):
+    terms = SEARCH_TERM_RE.findall(normalize_fa(text or ""))[:SEARCH_MAX_TERMS]
+    key = (" ".join(terms), offset)
+    cached = INLINE_CACHE.get(key, APPROVED_INDEX.version)
+    if cached is not None:
+        return cached
+    matches = list(itertools.islice(APPROVED_INDEX.search(terms), offset, offset + INLINE_PAGE_SIZE + 1))
+    next_offset = str(offset + INLINE_PAGE_SIZE) if len(matches) > INLINE_PAGE_SIZE else ""
+    page = ([inline_result(ad) for ad in matches[:INLINE_PAGE_SIZE]], next_offset)
+    INLINE_CACHE.put(key, APPROVED_INDEX.version, page)
+    return page
+
+# پاسخ به کوئری‌های inline (@bolori_car_bot ...)
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.inline_query
+    try:
+        offset = max(0, int(query.offset or 0))
+    except ValueError:
+        offset = 0
+    results, next_offset = inline_page(query.query, offset)
+    await query.answer(results, cache_time=INLINE_CACHE_TIME, next_offset=next_offset)
+
+# وضعیت مرور صفحه‌ای یک کاربر
+class BrowseSession:
+    __slots__ = ("ad_type", "page", "first_key", "last_key", "message_id", "query", "touched")
+
+    def __init__(self, ad_type, page, first_key, last_key, message_id, query=None):
+        self.ad_type = ad_type
+        self.page = page
+        self.first_key = first_key
+        self.last_key = last_key
+        self.message_id = message_id
+        self.query = query
+        self.touched = time.monotonic()
+
+    # صفحه و مکان‌نمای درخواست بعدی بر اساس جهت حرکت
+    def step(self, direction):
+        if direction == "n":
+            return self.page + 1, self.last_key, direction
+        return self.page - 1, self.first_key, direction
+
+# نگهداری جلسات مرور با سقف تعداد و انقضای زمانی (LRU)
+class BrowseSessionStore:
+    def __init__(self, ttl=BROWSE_SESSION_TTL, max_entries=BROWSE_SESSION_MAX):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def get(self, user_id):
+        session = self._sessions.get(user_id)
+        if session is None:
+            return None
+        if time.monotonic() - session.touched > self.ttl:
+            del self._sessions[user_id]
+            return None
+        return session
+
+    def put(self, user_id, session):
+        self._sessions[user_id] = session
+        self._sessions.move_to_end(user_id)
+        while len(self._sessions) > self.max_entries:
+            self._sessions.popitem(last=False)
+        # چون ترتیب با زمان استفاده یکی است، منقضی‌ها همیشه ابتدای صف‌اند
+        now = time.monotonic()
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if now - oldest.touched <= self.ttl:
+                break
+            self._sessions.popitem(last=False)
+
+BROWSE_SESSIONS = BrowseSessionStore()
+
+# داده دکمه‌های صفحه‌بندی
+def page_callback_data(ad_type):
+    return f"page_{ad_type or 'all'}"
+
+# ارسال یک صفحه از آگهی‌ها همراه با دکمه‌های قبلی/بعدی؛ شناسه پیام ناوبری را برمی‌گرداند
+async def send_ads_page(context, user_id, ads, page, has_next, callback_prefix, header):
+    keyboard = []
+    if page > 0:
+        keyboard.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"{callback_prefix}_p"))
+    if has_next:
+        keyboard.append(InlineKeyboardButton("➡️ بعدی", callback_data=f"{callback_prefix}_n"))
+
+    for ad in ads:
+        rendered = RENDER_CACHE.get(ad, "listing")
+        ad_text = rendered.text
+        if rendered.media:
+            try:
+                await context.bot.send_media_group(chat_id=user_id, media=rendered.media)
+            except Exception as e:
+                logger.error(f"Error sending media: {e}")
+                await context.bot.send_message(chat_id=user_id, text=ad_text)
+        else:
+            await context.bot.send_message(chat_id=user_id, text=ad_text)
+
+    if not keyboard:
+        return None
+    nav_message = await context.bot.send_message(
+        chat_id=user_id,
+        text=header,
+        reply_markup=InlineKeyboardMarkup([keyboard])
+    )
+    return nav_message.message_id
+
 # نمایش آگهی‌ها
-async def show_ads(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0, ad_type=None):
+async def show_ads(update: Update, context: ContextTypes.DEFAULT_TYPE, ad_type=None, direction="n", session=None):
     user_id = update.effective_user.id
     try:
-        with get_db_connection() as conn:
-            if ad_type:
-                total_ads = conn.execute("SELECT COUNT(*) FROM ads WHERE status = 'approved' AND type = ?", (ad_type,)).fetchone()[0]
-                ads = conn.execute(
-                    "SELECT * FROM ads WHERE status = 'approved' AND type = ? ORDER BY created_at DESC LIMIT 5 OFFSET ?",
-                    (ad_type, page * 5)
-                ).fetchall()
-            else:
-                total_ads = conn.execute("SELECT COUNT(*) FROM ads WHERE status = 'approved'").fetchone()[0]
-                ads = conn.execute(
-                    "SELECT * FROM ads WHERE status = 'approved' ORDER BY created_at DESC LIMIT 5 OFFSET ?",
-                    (page * 5,)
-                ).fetchall()
+        page, cursor, direction = session.step(direction) if session else (0, None, "n")
+        ads, has_more = APPROVED_INDEX.page(ad_type, cursor, direction)
+        total_ads = APPROVED_INDEX.count(ad_type)
 
         if not ads:
             await update.effective_message.reply_text("📭 هیچ آیتمی برای نمایش موجود نیست.")
             return
 
-        current_pages[user_id] = page
+        message_id = await send_ads_page(
+            context, user_id, ads, page, has_more if direction == "n" else True,
+            page_callback_data(ad_type), f"صفحه {page + 1} - تعداد آیتم‌ها: {total_ads}"
+        )
+        BROWSE_SESSIONS.put(
+            user_id, BrowseSession(ad_type, page, ads[0].sort_key, ads[-1].sort_key, message_id)
+        )
+    except Exception as e:
+        logger.error(f"Error showing ads: {str(e)}")
+        await update.effective_message.reply_text("❌ خطایی در نمایش آیتم‌ها رخ داد.")
 
-        keyboard = []
-        if page > 0:
-            keyboard.append(InlineKeyboardButton("⬅️ قبلی", callback_data=f"page_{page - 1}"))
-        if (page + 1) * 5 < total_ads:
-            keyboard.append(InlineKeyboardButton("➡️ بعدی", callback_data=f"page_{page + 1}"))
+# ساخت عبارت MATCH برای FTS5 از متن کاربر (هر کلمه به صورت پیشوندی)
+SEARCH_TERM_RE = re.compile(r"\w+")
+SEARCH_MAX_TERMS = 8
+
+def build_match_query(text):
+    terms = SEARCH_TERM_RE.findall(normalize_fa(text or ""))[:SEARCH_MAX_TERMS]
+    return " ".join(f'"{term}"*' for term in terms)
+
+# جست‌وجوی رتبه‌بندی‌شده با صفحه‌بندی keyset روی (rank, id)
+# محاسبه bm25 برای هر ردیف منطبق هزینه دارد، پس فقط جدیدترین SEARCH_RANK_WINDOW نتیجه رتبه‌بندی می‌شوند؛
+# مرز این پنجره (floor) در مکان‌نما نگه داشته می‌شود تا صفحه‌های بعدی روی همان مجموعه بمانند
+async def search_ads(text, cursor=None, direction="n", limit=PAGE_SIZE):
+    match = build_match_query(text)
+    if not match:
+        return [], False, 0
+
+    def op(conn):
+        if cursor is None:
+            row = conn.execute(
+                "SELECT rowid FROM ads_fts WHERE ads_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+                (match, SEARCH_RANK_WINDOW - 1)
+            ).fetchone()
+            floor = row[0] if row else 0
+            keyset, params = "", (match, floor)
+        else:
+            rank, ad_id, floor = cursor
+            keyset = f"AND (ads_fts.rank, ads.id) {'>' if direction == 'n' else '<'} (?, ?)"
+            params = (match, floor, rank, ad_id)
+        order = "ASC" if direction == "n" else "DESC"
+        rows = conn.execute(
+            f"""SELECT ads.*, ads_fts.rank AS rank FROM ads_fts JOIN ads ON ads.id = ads_fts.rowid
+                WHERE ads_fts MATCH ? AND ads_fts.rowid >= ? AND ads.status = 'approved' {keyset}
+                ORDER BY ads_fts.rank {order}, ads.id {order} LIMIT ?""",
+            (*params, limit + 1)
+        ).fetchall()
+        return rows, floor
+
+    rows, floor = await DB.run(op, op="search")
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction != "n":
+        rows.reverse()
+    return rows, has_more, floor
+
+# نمایش نتایج جست‌وجو
+async def show_search_results(update: Update, context: ContextTypes.DEFAULT_TYPE, text, direction="n", session=None):
+    user_id = update.effective_user.id
+    try:
+        page, cursor, direction = session.step(direction) if session else (0, None, "n")
+        ads, has_more, floor = await search_ads(text, cursor, direction)
+        if not ads:
+            await update.effective_message.reply_text(f"🔍 نتیجه‌ای برای «{text}» یافت نشد.")
+            return
+        message_id = await send_ads_page(
+            context, user_id, ads, page, has_more if direction == "n" else True,
+            "search", f"🔍 نتایج «{text}» - صفحه {page + 1}"
+        )
+        BROWSE_SESSIONS.put(
+            user_id,
+            BrowseSession("search", page, (ads[0]['rank'], ads[0]['id'], floor),
+                          (ads[-1]['rank'], ads[-1]['id'], floor), message_id, query=text)
+        )
+    except Exception as e:
+        logger.error(f"Error searching ads for {text!r}: {e}", exc_info=True)
+        await update.effective_message.reply_text("❌ خطایی در جست‌وجو رخ داد.")
 
-        reply_markup = InlineKeyboardMarkup([keyboard]) if keyboard else None
+# دستور search
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if context.args:
+        await show_search_results(update, context, " ".join(context.args))
+    else:
+        await ask_search_query(update)
 
-        for ad in ads:
-            images = safe_json_loads(ad['image_id'])
-            ad_text = (
-                f"🚗 {translate_ad_type(ad['type'])}: {ad['title']}\n"
-                f"📝 توضیحات: {ad['description']}\n"
-                f"💰 قیمت: {ad['price']:,} تومان\n"
-                f"""➖➖➖➖➖
-☑️ اتوگالــری بلـــوری
-▫️خرید▫️فروش▫️کارشناسی
-+989153632957
-➖➖➖➖
-@Bolori_Car
-جهت ثبت آگهی تان به ربات زیر مراجعه کنید.
-@bolori_car_bot"""
-            )
-            if images:
-                try:
-                    media = [InputMediaPhoto(media=photo, caption=ad_text if i == 0 else None)
-                             for i, photo in enumerate(images)]
-                    await context.bot.send_media_group(chat_id=user_id, media=media)
-                except Exception as e:
-                    logger.error(f"Error sending media: {e}")
-                    await context.bot.send_message(chat_id=user_id, text=ad_text)
-            else:
-                await context.bot.send_message(chat_id=user_id, text=ad_text)
-            await asyncio.sleep(0.5)
+# درخواست عبارت جست‌وجو از کاربر
+async def ask_search_query(update: Update):
+    await FSM_STORE.set(update.effective_user.id, {"state": "search_query"})
+    await update.effective_message.reply_text("🔍 عبارت مورد نظر را وارد کنید (مثلاً: پژو 207 سفید):")
 
-        if reply_markup:
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=f"صفحه {page + 1} - تعداد آیتم‌ها: {total_ads}",
-                reply_markup=reply_markup
-            )
+# دکمه‌های صفحه‌بندی نتایج جست‌وجو
+async def handle_search_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    session = BROWSE_SESSIONS.get(query.from_user.id)
+    if session is None or session.query is None or session.message_id != query.message.message_id:
+        await query.message.reply_text("⌛ این نتایج منقضی شده است. لطفاً دوباره جست‌وجو کنید (/search).")
+        return
+    try:
+        await query.message.delete()
+    except BadRequest as e:
+        logger.warning("Couldn't delete message: %s", e)
+    await show_search_results(update, context, session.query, direction=query.data[-1], session=session)
+
+# بازه‌های آماده فیلتر (قیمت به تومان، تازگی به روز)
+FILTER_PRICES = [
+    (None, None, "هر قیمتی"),
+    (None, 500_000_000, "تا ۵۰۰ میلیون"),
+    (500_000_000, 1_000_000_000, "۵۰۰ میلیون تا ۱ میلیارد"),
+    (1_000_000_000, 2_000_000_000, "۱ تا ۲ میلیارد"),
+    (2_000_000_000, None, "بیش از ۲ میلیارد"),
+]
+FILTER_AGES = [(None, "همه زمان‌ها"), (1, "۲۴ ساعت"), (3, "۳ روز"), (7, "۷ روز"), (30, "۳۰ روز")]
+FILTER_TYPES = [(None, "همه"), ("ad", "آگهی"), ("referral", "حواله")]
+
+# فیلترهای انتخاب‌شده کاربر (اندیس گزینه‌ها؛ کل وضعیت در callback_data جا می‌شود)
+class AdFilter:
+    __slots__ = ("type_index", "price_index", "age_index")
+
+    def __init__(self, type_index=0, price_index=0, age_index=0):
+        self.type_index = type_index
+        self.price_index = price_index
+        self.age_index = age_index
+
+    @classmethod
+    def parse(cls, encoded):
+        values = [int(value) for value in encoded.split("_")]
+        if not (0 <= values[0] < len(FILTER_TYPES) and 0 <= values[1] < len(FILTER_PRICES)
+                and 0 <= values[2] < len(FILTER_AGES)):
+            raise ValueError(f"Invalid filter {encoded}")
+        return cls(*values)
+
+    def encode(self):
+        return f"{self.type_index}_{self.price_index}_{self.age_index}"
+
+    def replace(self, **changes):
+        values = {name: getattr(self, name) for name in self.__slots__}
+        values.update(changes)
+        return AdFilter(**values)
+
+    @property
+    def ad_type(self):
+        return FILTER_TYPES[self.type_index][0]
+
+    @property
+    def price_range(self):
+        return FILTER_PRICES[self.price_index][:2]
+
+    @property
+    def created_after(self):
+        days = FILTER_AGES[self.age_index][0]
+        return (datetime.now() - timedelta(days=days)).isoformat() if days else None
+
+    def describe(self):
+        return (f"نوع: {FILTER_TYPES[self.type_index][1]} | قیمت: {FILTER_PRICES[self.price_index][2]}"
+                f" | زمان: {FILTER_AGES[self.age_index][1]}")
+
+def filter_callback_data(prefix, ad_filter):
+    return f"{prefix}_{ad_filter.encode()}"
+
+# ساخت کوئری فهرست فیلترشده؛ هر ترکیب فیلتر به ترتیب (created_at, id) روی idx_ads_listing_price
+# (با نوع) یا idx_ads_recent_price (بدون نوع) خوانده می‌شود و قیمت از همان ورودی ایندکس بررسی می‌شود،
+# بدون اسکن کامل یا مرتب‌سازی موقت (bench.py plans همین را بررسی می‌کند)
+def build_filter_query(ad_type=None, min_price=None, max_price=None, created_after=None,
+                       cursor=None, direction="n", limit=PAGE_SIZE):
+    where = ["status = 'approved'"]
+    params = []
+    if ad_type:
+        where.append("type = ?")
+        params.append(ad_type)
+    if min_price is not None:
+        where.append("price >= ?")
+        params.append(min_price)
+    if max_price is not None:
+        where.append("price < ?")
+        params.append(max_price)
+    if created_after:
+        where.append("created_at >= ?")
+        params.append(created_after)
+    if cursor is not None:
+        where.append(f"(created_at, id) {'<' if direction == 'n' else '>'} (?, ?)")
+        params.extend(cursor)
+    order = "DESC" if direction == "n" else "ASC"
+    sql = (f"SELECT * FROM ads WHERE {' AND '.join(where)} "
+           f"ORDER BY created_at {order}, id {order} LIMIT ?")
+    return sql, (*params, limit + 1)
+
+# فهرست آگهی‌های تأییدشده با فیلتر قیمت، نوع و تازگی (جدیدترین اول، صفحه‌بندی keyset)
+async def filter_ads(ad_type=None, min_price=None, max_price=None, created_after=None,
+                     cursor=None, direction="n", limit=PAGE_SIZE):
+    sql, params = build_filter_query(ad_type, min_price, max_price, created_after, cursor, direction, limit)
+    rows = await DB.fetchall(sql, params)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if direction != "n":
+        rows.reverse()
+    return rows, has_more
+
+# منوی فیلتر با علامت گزینه‌های انتخاب‌شده
+def filter_menu_markup(ad_filter):
+    def option(label, selected, changed):
+        return InlineKeyboardButton(("✅ " if selected else "") + label,
+                                    callback_data=filter_callback_data("flt", changed))
+    rows = [
+        [option(label, i == ad_filter.type_index, ad_filter.replace(type_index=i))
+         for i, (_, label) in enumerate(FILTER_TYPES)],
+    ]
+    rows.extend([option(label, i == ad_filter.price_index, ad_filter.replace(price_index=i))]
+                for i, (_, _, label) in enumerate(FILTER_PRICES))
+    ages = [option(label, i == ad_filter.age_index, ad_filter.replace(age_index=i))
+            for i, (_, label) in enumerate(FILTER_AGES)]
+    rows.extend([ages[:3], ages[3:]])
+    rows.append([InlineKeyboardButton("🔍 نمایش نتایج", callback_data=filter_callback_data("flts", ad_filter))])
+    return InlineKeyboardMarkup(rows)
+
+# نمایش نتایج فیلتر
+async def show_filtered_ads(update: Update, context: ContextTypes.DEFAULT_TYPE, ad_filter, direction="n", session=None):
+    user_id = update.effective_user.id
+    try:
+        page, cursor, direction = session.step(direction) if session else (0, None, "n")
+        min_price, max_price = ad_filter.price_range
+        # مرز زمانی در جلسه ثابت می‌ماند تا صفحه‌ها روی یک مجموعه بمانند
+        created_after = session.query[1] if session else ad_filter.created_after
+        ads, has_more = await filter_ads(ad_filter.ad_type, min_price, max_price, created_after, cursor, direction)
+        if not ads:
+            await update.effective_message.reply_text("📭 آیتمی با این فیلترها یافت نشد.")
+            return
+        message_id = await send_ads_page(
+            context, user_id, ads, page, has_more if direction == "n" else True,
+            "fltp", f"🎯 {ad_filter.describe()}\nصفحه {page + 1}"
+        )
+        BROWSE_SESSIONS.put(
+            user_id,
+            BrowseSession("filter", page, (ads[0]['created_at'], ads[0]['id']),
+                          (ads[-1]['created_at'], ads[-1]['id']), message_id, query=(ad_filter, created_after))
+        )
     except Exception as e:
-        logger.error(f"Error showing ads: {str(e)}")
+        logger.error(f"Error showing filtered ads: {e}", exc_info=True)
         await update.effective_message.reply_text("❌ خطایی در نمایش آیتم‌ها رخ داد.")
 
+# دکمه‌های منوی فیلتر، نمایش نتایج و صفحه‌بندی آن
+async def handle_filter_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    prefix, _, encoded = query.data.partition("_")
+    if prefix == "fltp":
+        session = BROWSE_SESSIONS.get(query.from_user.id)
+        if session is None or session.ad_type != "filter" or session.message_id != query.message.message_id:
+            await query.message.reply_text("⌛ این نتایج منقضی شده است. لطفاً دوباره فیلتر را انتخاب کنید.")
+            return
+        try:
+            await query.message.delete()
+        except BadRequest as e:
+            logger.warning("Couldn't delete message: %s", e)
+        await show_filtered_ads(update, context, session.query[0], direction=encoded, session=session)
+        return
+    try:
+        ad_filter = AdFilter.parse(encoded)
+    except (ValueError, IndexError):
+        logger.warning("Invalid filter callback: %s", query.data)
+        return
+    if prefix == "flts":
+        await show_filtered_ads(update, context, ad_filter)
+        return
+    text = f"🎯 فیلتر آگهی‌ها\n{ad_filter.describe()}"
+    if query.message.text and query.message.reply_markup and query.message.text.startswith("🎯 فیلتر"):
+        try:
+            await query.edit_message_text(text, reply_markup=filter_menu_markup(ad_filter))
+        except BadRequest as e:
+            logger.debug("Filter menu not modified: %s", e)
+    else:
+        await query.message.reply_text(text, reply_markup=filter_menu_markup(ad_filter))
+
 # بررسی آگهی‌ها
 async def review_ads(update: Update, context: ContextTypes.DEFAULT_TYPE, ad_type=None):
     user_id = update.effective_user.id
-    logger.debug(f"Review ads requested by user {user_id} for type {ad_type}")
+    logger.debug("Review ads requested by user %s for type %s", user_id, ad_type)
     if user_id not in ADMIN_ID:
         await update.effective_message.reply_text("⚠️ شما دسترسی ادمین ندارید.")
         return
     try:
-        with get_db_connection() as conn:
-            if ad_type:
-                ads = conn.execute(
-                    "SELECT * FROM ads WHERE status = 'pending' AND type = ? ORDER BY created_at ASC LIMIT 1",
-                    (ad_type,)
-                ).fetchone()
-            else:
-                ads = conn.execute(
-                    "SELECT * FROM ads WHERE status = 'pending' ORDER BY created_at ASC LIMIT 1"
-                ).fetchone()
-            if not ads:
-                await update.effective_message.reply_text(
-                    f"📪 هیچ {translate_ad_type(ad_type) if ad_type else 'آیتمی'} در انتظار تأییدی یافت نشد.")
-                return
-            images = safe_json_loads(ads['image_id'])
-            ad_text = (
-                f"📋 {translate_ad_type(ads['type'])}: {ads['title']}\n"
-                f"توضیحات: {ads['description']}\n"
-                f"شماره تماس: {ads['phone']}\n"
-                f"قیمت: {ads['price']:,} تومان\n"
-                f"کاربر: {ads['user_id']}"
+        if ad_type:
+            ads = await DB.fetchone(
+                "SELECT * FROM ads WHERE status = 'pending' AND type = ? ORDER BY created_at ASC LIMIT 1",
+                (ad_type,)
+            )
+        else:
+            ads = await DB.fetchone(
+                "SELECT * FROM ads WHERE status = 'pending' ORDER BY created_at ASC LIMIT 1"
+            )
+        if not ads:
+            await update.effective_message.reply_text(
+                f"📪 هیچ {translate_ad_type(ad_type) if ad_type else 'آیتمی'} در انتظار تأییدی یافت نشد.")
+            return
+        rendered = RENDER_CACHE.get(ads, "review")
+        images, ad_text = rendered.images, rendered.text
+        buttons = [
+            [InlineKeyboardButton("✅ تأیید", callback_data=f"approve_{ads['type']}_{ads['id']}")],
+            [InlineKeyboardButton("❌ رد", callback_data=f"reject_{ads['type']}_{ads['id']}")]
+        ]
+        if images:
+            await context.bot.send_photo(
+                chat_id=user_id,
+                photo=images[0],
+                caption=ad_text,
+                reply_markup=InlineKeyboardMarkup(buttons)
+            )
+            for photo in images[1:]:
+                await context.bot.send_photo(chat_id=user_id, photo=photo)
+        else:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text=ad_text,
+                reply_markup=InlineKeyboardMarkup(buttons)
             )
-            buttons = [
-                [InlineKeyboardButton("✅ تأیید", callback_data=f"approve_{ads['type']}_{ads['id']}")],
-                [InlineKeyboardButton("❌ رد", callback_data=f"reject_{ads['type']}_{ads['id']}")]
-            ]
-            if images:
-                await context.bot.send_photo(
-                    chat_id=user_id,
-                    photo=images[0],
-                    caption=ad_text,
-                    reply_markup=InlineKeyboardMarkup(buttons)
-                )
-                for photo in images[1:]:
-                    await context.bot.send_photo(chat_id=user_id, photo=photo)
-                    await asyncio.sleep(0.5)
-            else:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=ad_text,
-                    reply_markup=InlineKeyboardMarkup(buttons)
-                )
     except Exception as e:
         logger.error(f"Error in review_ads: {str(e)}", exc_info=True)
         await update.effective_message.reply_text("❌ خطایی در بررسی آیتم‌ها رخ داد.")
@@ -874,44 +3064,50 @@ async def review_ads(update: Update, context: ContextTypes.DEFAULT_TYPE, ad_type
 async def message_dispatcher(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     logger.debug(
-        f"Message dispatcher for user {user_id}: {update.message.text if update.message and update.message.text else 'Non-text message'}")
+        "Message dispatcher for user %s: %s", user_id,
+        update.message.text if update.message and update.message.text else 'Non-text message'
+    )
 
     if not update.message:
-        logger.warning(f"Received update without message: {update.to_dict()}")
+        logger.warning("Received update without message: %s", update.to_dict())
         return
 
-    with FSM_LOCK:
-        if user_id not in FSM_STATES or "state" not in FSM_STATES[user_id]:
-            logger.debug(f"No FSM state for user {user_id}, prompting to start")
-            await update.message.reply_text("لطفاً فرآیند ثبت آگهی یا حواله را با زدن دکمه‌های مربوطه شروع کنید.")
+    draft = await FSM_STORE.get(user_id)
+    state = draft.get("state")
+    if not state:
+        logger.debug("No FSM state for user %s, prompting to start", user_id)
+        await update.message.reply_text("لطفاً فرآیند ثبت آگهی یا حواله را با زدن دکمه‌های مربوطه شروع کنید.")
+        return
+    logger.debug("User %s is in state %s", user_id, state)
+
+    step = WIZARD_STEPS.get(state)
+    if step is not None:
+        await handle_wizard_message(update, context, step, draft)
+    elif state == "search_query":
+        if not update.message.text:
+            await update.message.reply_text("لطفاً عبارت جست‌وجو را به صورت متن بفرستید.")
             return
-        state = FSM_STATES[user_id]["state"]
-    logger.debug(f"User {user_id} is in state {state}")
-
-    if state.startswith("post_ad"):
-        await post_ad_handle_message(update, context)
-    elif state.startswith("post_referral"):
-        await post_referral_handle_message(update, context)
+        await FSM_STORE.clear(user_id)
+        await show_search_results(update, context, update.message.text)
     elif state == "broadcast_message":
         if update.message.photo:
             photo = update.message.photo[-1].file_id
             caption = update.message.caption or ""
-            FSM_STATES[user_id]["broadcast_photo"] = photo
-            FSM_STATES[user_id]["broadcast_caption"] = caption
+            draft = await FSM_STORE.update(user_id, broadcast_photo=photo, broadcast_caption=caption)
         elif update.message.text:
-            FSM_STATES[user_id]["broadcast_text"] = update.message.text
+            draft = await FSM_STORE.update(user_id, broadcast_text=update.message.text)
         else:
             await update.message.reply_text("لطفاً متن یا عکس بفرستید.")
             return
 
-        if "broadcast_photo" in FSM_STATES[user_id]:
+        if "broadcast_photo" in draft:
             await context.bot.send_photo(
                 chat_id=user_id,
-                photo=FSM_STATES[user_id]["broadcast_photo"],
-                caption=FSM_STATES[user_id].get("broadcast_caption", "")
+                photo=draft["broadcast_photo"],
+                caption=draft.get("broadcast_caption", "")
             )
-        elif "broadcast_text" in FSM_STATES[user_id]:
-            await context.bot.send_message(chat_id=user_id, text=FSM_STATES[user_id]["broadcast_text"])
+        elif "broadcast_text" in draft:
+            await context.bot.send_message(chat_id=user_id, text=draft["broadcast_text"])
 
         buttons = [
             [InlineKeyboardButton("✅ ارسال به همه", callback_data="confirm_broadcast")],
@@ -923,11 +3119,9 @@ async def message_dispatcher(update: Update, context: ContextTypes.DEFAULT_TYPE)
             reply_markup=InlineKeyboardMarkup(buttons)
         )
     else:
-        logger.debug(f"Invalid state for user {user_id}: {state}")
+        logger.debug("Invalid state for user %s: %s", user_id, state)
         await update.message.reply_text("⚠️ حالت نامعتبر. لطفاً دوباره فرآیند را شروع کنید.")
-        with FSM_LOCK:
-            if user_id in FSM_STATES:
-                del FSM_STATES[user_id]
+        await FSM_STORE.clear(user_id)
 
 # مدیریت Callback
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -935,9 +3129,10 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     callback_data = query.data
     user_id = query.from_user.id
-    logger.debug(f"Callback received from user {user_id}: {callback_data}")
+    logger.debug("Callback received from user %s: %s", user_id, callback_data)
 
     if callback_data == "check_membership":
+        MEMBERSHIP_CACHE.invalidate(user_id)
         if await check_membership(update, context):
             await start(update, context)
         else:
@@ -950,12 +3145,13 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await show_ads(update, context, ad_type="ad")
     elif callback_data == "show_ads_referral":
         await show_ads(update, context, ad_type="referral")
+    elif callback_data == "search":
+        await ask_search_query(update)
     elif callback_data == "stats":
         await stats(update, context)
     elif callback_data == "broadcast_message":
         if user_id in ADMIN_ID:
-            with FSM_LOCK:
-                FSM_STATES[user_id] = {"state": "broadcast_message"}
+            await FSM_STORE.set(user_id, {"state": "broadcast_message"})
             await query.message.reply_text("لطفاً پیام (متن یا عکس) را ارسال کنید.")
         else:
             await query.message.reply_text("⚠️ شما ادمین نیستید.")
@@ -964,37 +3160,29 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 _, ad_type, ad_id = callback_data.split("_")
                 ad_id = int(ad_id)
-                with get_db_connection() as conn:
-                    ad = conn.execute(
-                        "SELECT id, user_id, title, description, price, image_id, phone, type FROM ads WHERE id = ?",
-                        (ad_id,),
-                    ).fetchone()
-                    if not ad:
-                        logger.error(f"Ad with id {ad_id} not found")
-                        await query.message.reply_text("❌ آگهی یافت نشد.")
-                        return
-                    conn.execute(
-                        "UPDATE ads SET status = 'approved' WHERE id = ?",
-                        (ad_id,),
-                    )
-                    conn.commit()
+                ad = await DB.fetchone(
+                    "SELECT id, user_id, title, description, price, image_id, phone, type, created_at FROM ads WHERE id = ?",
+                    (ad_id,),
+                )
+                if not ad:
+                    logger.error(f"Ad with id {ad_id} not found")
+                    await query.message.reply_text("❌ آگهی یافت نشد.")
+                    return
+                job = await approve_ad(ad, admin_chat_id=user_id)
+                RENDER_CACHE.invalidate(ad_id)
+                APPROVED_INDEX.add(ad)
 
-                logger.debug(f"Ad {ad_id} approved by admin {user_id}")
+                logger.debug("Ad %s approved by admin %s", ad_id, user_id)
                 await query.message.reply_text(f"✅ آگهی/حواله با موفقیت تأیید شد.")
 
                 await context.bot.send_message(
                     chat_id=ad['user_id'],
-                    text=(
-                        f"✅ {translate_ad_type(ad_type)} شما تأیید شد:\n"
-                        f"عنوان: {ad['title']}\n"
-                        f"توضیحات: {ad['description']}\n"
-                        f"قیمت: {ad['price']:,} تومان\n\n"
-                        f"📢 برای مشاهده آگهی‌های دیگر، از دکمه 'نمایش آگهی‌ها' استفاده کنید."
-                    ),
+                    text=RENDER_CACHE.get(ad, "approved").text,
+                    rate_limit_args=PRIORITY_ADMIN
                 )
 
-                asyncio.create_task(broadcast_ad(context, ad))
-                logger.debug(f"Ad {ad_id} broadcasted to users")
+                logger.debug("Broadcasting ad %s to all users", ad_id)
+                await run_broadcast_job(context.bot, job)
                 backup_db()  # بکاپ‌گیری بعد از تأیید آگهی
             except Exception as e:
                 logger.error(f"Error in approve for ad {ad_id}: {e}", exc_info=True)
@@ -1006,23 +3194,24 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             try:
                 _, ad_type, ad_id = callback_data.split("_")
                 ad_id = int(ad_id)
-                with get_db_connection() as conn:
-                    ad = conn.execute(
-                        "SELECT user_id FROM ads WHERE id = ?", (ad_id,)
-                    ).fetchone()
-                    if not ad:
-                        logger.error(f"Ad with id {ad_id} not found")
-                        await query.message.reply_text("❌ آگهی یافت نشد.")
-                        return
-                    conn.execute(
-                        "UPDATE ads SET status = 'rejected' WHERE id = ?",
-                        (ad_id,)
-                    )
-                    conn.commit()
+                ad = await DB.fetchone(
+                    "SELECT user_id FROM ads WHERE id = ?", (ad_id,)
+                )
+                if not ad:
+                    logger.error(f"Ad with id {ad_id} not found")
+                    await query.message.reply_text("❌ آگهی یافت نشد.")
+                    return
+                await DB.write(
+                    "UPDATE ads SET status = 'rejected' WHERE id = ?",
+                    (ad_id,)
+                )
+                RENDER_CACHE.invalidate(ad_id)
+                APPROVED_INDEX.remove(ad_id)
                 await query.message.reply_text(f"❌ {translate_ad_type(ad_type)} رد شد.")
                 await context.bot.send_message(
                     chat_id=ad['user_id'],
-                    text=f"❌ {translate_ad_type(ad_type)} شما رد شد. لطفاً با ادمین تماس بگیرید."
+                    text=f"❌ {translate_ad_type(ad_type)} شما رد شد. لطفاً با ادمین تماس بگیرید.",
+                    rate_limit_args=PRIORITY_ADMIN
                 )
                 backup_db()  # بکاپ‌گیری بعد از رد آگهی
             except Exception as e:
@@ -1031,38 +3220,29 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await query.message.reply_text("⚠️ شما ادمین نیستید.")
     elif callback_data == "confirm_broadcast":
-        if user_id in ADMIN_ID and FSM_STATES.get(user_id, {}).get("state") == "broadcast_message":
+        draft = await FSM_STORE.get(user_id)
+        if user_id in ADMIN_ID and draft.get("state") == "broadcast_message":
             try:
-                with get_db_connection() as conn:
-                    users = conn.execute("SELECT user_id FROM users").fetchall()
-
-                if "broadcast_photo" in FSM_STATES[user_id]:
-                    photo = FSM_STATES[user_id]["broadcast_photo"]
-                    caption = FSM_STATES[user_id].get("broadcast_caption", "")
-                    for user in users:
-                        await context.bot.send_photo(chat_id=user["user_id"], photo=photo, caption=caption)
-                        await asyncio.sleep(0.1)
-                elif "broadcast_text" in FSM_STATES[user_id]:
-                    text = FSM_STATES[user_id]["broadcast_text"]
-                    for user in users:
-                        await context.bot.send_message(chat_id=user["user_id"], text=text)
-                        await asyncio.sleep(0.1)
-
-                await query.message.reply_text("✅ پیام با موفقیت به همه ارسال شد.")
+                if "broadcast_photo" in draft:
+                    payload = {
+                        "photo": draft["broadcast_photo"],
+                        "caption": draft.get("broadcast_caption", "")
+                    }
+                else:
+                    payload = {"text": draft["broadcast_text"]}
+                await start_broadcast(context.bot, user_id, "message", payload, "ارسال پیام همگانی")
+                await query.message.reply_text("⏳ ارسال پیام به همه آغاز شد. پیشرفت کار در پیام وضعیت نمایش داده می‌شود.")
             except Exception as e:
                 await query.message.reply_text(f"❌ خطا در ارسال: {e}")
             finally:
-                with FSM_LOCK:
-                    del FSM_STATES[user_id]
+                await FSM_STORE.clear(user_id)
         else:
             await query.message.reply_text("⚠️ دسترسی ندارید.")
     elif callback_data == "cancel_broadcast":
-        with FSM_LOCK:
-            if user_id in FSM_STATES:
-                del FSM_STATES[user_id]
+        await FSM_STORE.clear(user_id)
         await query.message.reply_text("❌ ارسال پیام لغو شد.")
     else:
-        logger.warning(f"Unknown callback data: {callback_data}")
+        logger.warning("Unknown callback data: %s", callback_data)
         await query.message.reply_text("⚠️ گزینه ناشناخته.")
 
 # مدیریت خطاها
@@ -1081,29 +3261,51 @@ async def handle_page_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
     user_id = query.from_user.id
-    page = int(query.data.split("_")[1])
+    parts = query.data.split("_", 2)
+    if len(parts) != 3 or parts[1] not in ("all", "ad", "referral") or parts[2] not in ("n", "p"):
+        # دکمه‌های قالب قدیمی (page_<n>) که هنوز در چت‌ها مانده‌اند: نمایش صفحه اول همه آگهی‌ها
+        ad_type, direction, session = None, "n", None
+    else:
+        _, ad_type, direction = parts
+        ad_type = None if ad_type == "all" else ad_type
+        session = BROWSE_SESSIONS.get(user_id)
+        if session is not None and (session.ad_type != ad_type or session.message_id != query.message.message_id):
+            session = None  # دکمه قدیمی یا جلسه منقضی؛ از صفحه اول شروع می‌کنیم
 
     try:
         await query.message.delete()
     except BadRequest as e:
-        logger.warning(f"Couldn't delete message: {e}")
+        logger.warning("Couldn't delete message: %s", e)
     except Exception as e:
         logger.error(f"Error deleting message: {e}")
 
-    await show_ads(update, context, page=page)
+    await show_ads(update, context, ad_type=ad_type, direction=direction, session=session)
 
 # ساخت اپلیکیشن
 def get_application():
-    application = Application.builder().token(BOT_TOKEN).build()
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("cancel", cancel))
-    application.add_handler(CommandHandler("admin", admin))
-    application.add_handler(CommandHandler("stats", stats))
-    application.add_handler(CallbackQueryHandler(handle_callback))
-    application.add_handler(CallbackQueryHandler(handle_page_callback, pattern=r"^page_\d+$"))
+    builder = Application.builder().token(BOT_TOKEN).rate_limiter(OutboundScheduler())
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+    application = builder.build()
+    for command, callback in (("start", start), ("cancel", cancel), ("admin", admin), ("stats", stats),
+                              ("checkindex", check_index), ("search", search_command), ("profile", profile)):
+        application.add_handler(CommandHandler(command, instrument_handler(command, callback)))
+    application.add_handler(CallbackQueryHandler(
+        instrument_handler("show_ads", handle_page_callback), pattern=r"^page_"
+    ))
+    application.add_handler(CallbackQueryHandler(
+        instrument_handler("search", handle_search_callback), pattern=r"^search_[np]$"
+    ))
+    application.add_handler(CallbackQueryHandler(
+        instrument_handler("filter", handle_filter_callback), pattern=r"^flt[sp]?_"
+    ))
+    application.add_handler(InlineQueryHandler(instrument_handler("inline_query", inline_query)))
+    application.add_handler(CallbackQueryHandler(
+        instrument_handler("handle_callback", handle_callback, label=callback_label)
+    ))
     application.add_handler(MessageHandler(
         filters.TEXT | filters.PHOTO | filters.CONTACT | filters.COMMAND,
-        message_dispatcher
+        instrument_handler("message_dispatcher", message_dispatcher)
     ))
     application.add_error_handler(error_handler)
     return application
@@ -1112,53 +3314,105 @@ def get_application():
 async def main():
     logger.debug("Starting main function...")
     try:
-        init_db()
-        global ADMIN_ID, APPLICATION
-        ADMIN_ID = load_admins()
-        APPLICATION = get_application()
-        await APPLICATION.initialize()
-        logger.debug("Application initialized.")
-        await APPLICATION.start()
-        logger.debug("Application started.")
-        await APPLICATION.bot.delete_webhook(drop_pending_updates=True)
-        logger.debug("Webhook deleted.")
-        await APPLICATION.bot.set_webhook(
-            url=WEBHOOK_URL,
-            secret_token=WEBHOOK_SECRET if WEBHOOK_SECRET else None
-        )
-        logger.debug("Webhook set successfully.")
-        asyncio.create_task(process_update_queue())
-        logger.debug("Process update queue task created.")
+        global APPLICATION
+        with log_timing("update dedup"):
+            load_update_dedup()
+        init_update_queues()
+        with log_timing("application"):
+            APPLICATION = get_application()
+            await APPLICATION.initialize()
+            logger.debug("Application initialized.")
+            await APPLICATION.start()
+            logger.debug("Application started.")
+        with log_timing("webhook"):
+            await APPLICATION.bot.delete_webhook(drop_pending_updates=True)
+            logger.debug("Webhook deleted.")
+            await APPLICATION.bot.set_webhook(
+                url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET if WEBHOOK_SECRET else None
+            )
+            logger.debug("Webhook set successfully.")
+        with log_timing("broadcast resume"):
+            await resume_broadcast_jobs(APPLICATION.bot)
+        for worker_id in range(len(update_queues)):
+            update_workers.append(asyncio.create_task(process_update_queue(worker_id)))
+        logger.debug(f"{len(update_queues)} update worker tasks created.")
+        asyncio.create_task(checkpoint_update_dedup())
+        asyncio.create_task(sweep_fsm_states())
+        if TRACING:
+            asyncio.create_task(flush_traces())
+        if PROFILE_ON_START:
+            spec = parse_profile_spec(PROFILE_ON_START)
+            if spec:
+                start_profile(APPLICATION.bot, ADMIN_ID, *spec)
+            else:
+                logger.warning("Invalid PROFILE_ON_START value: %s", PROFILE_ON_START)
     except Exception as e:
         logger.error(f"Error in main: {e}", exc_info=True)
         raise
 
+# پردازش آپدیت‌های پذیرفته‌شده پیش از خاموش شدن؛ این آپدیت‌ها در پنجره تکراری‌ها هستند و تلگرام دوباره نمی‌فرستد
+async def drain_update_queues(timeout=UPDATE_DRAIN_TIMEOUT):
+    try:
+        await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in update_queues)), timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"{update_queue_size()} queued updates not processed within {timeout}s of shutdown")
+    for task in update_workers:
+        task.cancel()
+    await asyncio.gather(*update_workers, return_exceptions=True)
+    update_workers.clear()
+
 # تابع اجرا
 async def run():
+    startup_time = time.monotonic()
     init_db()
     global ADMIN_ID, APPLICATION
-    ADMIN_ID = load_admins()
+    with log_timing("admins"):
+        ADMIN_ID = load_admins()
+    with log_timing("approved index"):
+        load_approved_index()
+    with log_timing("fsm states"):
+        FSM_STORE.load()
     app.router.add_post('/webhook', webhook)
     app.router.add_get('/', health_check)
     app.router.add_get('/ping', uptime_check)
+    if METRICS_TOKEN:
+        app.router.add_get('/metrics', metrics_handler)
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner, '0.0.0.0', PORT)
     await site.start()
     logger.info(f"Server started on port {PORT}")
+    stop_event = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            asyncio.get_running_loop().add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
     try:
         await main()
-        await asyncio.Event().wait()
-    except KeyboardInterrupt:
+        logger.info(f"Startup finished in {time.monotonic() - startup_time:.3f} seconds")
+        await stop_event.wait()
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
+    except Exception as e:
+        logger.error(f"Error in run: {e}", exc_info=True)
+        raise
+    finally:
         logger.info("Shutting down...")
+        await site.stop()  # آپدیت تازه‌ای پذیرفته نشود
         if APPLICATION:
-            backup_db()  # بکاپ‌گیری قبل از خاموش شدن
+            await drain_update_queues()
+            await stop_broadcasts()
+            await save_update_dedup()
+            await TRACE_EXPORTER.flush()
+            await DB.flush()
+            await backup_now()  # بکاپ‌گیری قبل از خاموش شدن
             await APPLICATION.bot.delete_webhook(drop_pending_updates=True)
             await APPLICATION.stop()
         await runner.cleanup()
-    except Exception as e:
-        logger.error(f"Error in run: {e}", exc_info=True)
-        raise
+        await DB.flush()
+        DB.close()
 
 if __name__ == '__main__':
     asyncio.run(run())
@@ -0,0 +1,115 @@
+# گزارش کندترین آپدیت‌ها از فایل ردیابی ربات؛ اجرا: python trace_report.py [traces.jsonl ...] --top 10
+import argparse
+import glob
+import json
+import os
+import sys
+from collections import defaultdict
+from datetime import datetime
+
+
+# فایل‌های پیش‌فرض: فایل فعلی و نسخه‌های چرخش‌یافته
+def default_files():
+    path = os.getenv("TRACE_FILE", "traces.jsonl")
+    return [path] + sorted(glob.glob(f"{glob.escape(path)}.[0-9]*"))
+
+
+def load_traces(paths):
+    for path in paths:
+        try:
+            with open(path, encoding="utf-8") as f:
+                for number, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        print(f"{path}:{number}: skipping malformed line", file=sys.stderr)
+        except FileNotFoundError:
+            continue
+
+
+def span_label(span):
+    detail = span.get("handler") or span.get("method") or span.get("op") or span.get("step")
+    return f"{span['name']}:{detail}" if detail else span["name"]
+
+
+def span_extras(span):
+    skip = {"name", "start_ms", "duration_ms", "handler", "method", "op", "step"}
+    return " ".join(f"{key}={value}" for key, value in span.items() if key not in skip)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def matches(trace, args):
+    if trace["duration_ms"] < args.min_ms:
+        return False
+    if args.kind and trace.get("kind") != args.kind:
+        return False
+    if args.user and trace.get("user_id") != args.user:
+        return False
+    if args.handler and not any(span.get("handler") == args.handler for span in trace["spans"]):
+        return False
+    return True
+
+
+# مجموع زمان هر نوع بازه در همه ردیابی‌ها
+def print_breakdown(traces):
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    for trace in traces:
+        for span in trace["spans"]:
+            entry = totals[span_label(span)]
+            entry[0] += 1
+            entry[1] += span["duration_ms"]
+            entry[2] = max(entry[2], span["duration_ms"])
+    print("time by span (nested spans overlap: handler includes its db/bot_api calls)")
+    print(f"  {'span':<40} {'count':>7} {'total ms':>12} {'avg ms':>9} {'max ms':>10}")
+    for label, (count, total, longest) in sorted(totals.items(), key=lambda item: -item[1][1]):
+        print(f"  {label:<40} {count:>7} {total:>12.1f} {total / count:>9.2f} {longest:>10.1f}")
+
+
+def print_trace(rank, trace):
+    received = datetime.fromtimestamp(trace["received_at"]).isoformat(sep=" ", timespec="seconds")
+    flags = " sampled" if trace.get("sampled") else " slow"
+    if trace.get("error"):
+        flags += f" error={trace['error']}"
+    print(
+        f"#{rank} {trace['duration_ms']:.1f} ms  trace {trace['trace_id']}  update {trace.get('update_id')} "
+        f"{trace.get('kind')} user {trace.get('user_id')}  at {received}{flags}"
+    )
+    for span in sorted(trace["spans"], key=lambda span: span["start_ms"]):
+        print(f"  {span['start_ms']:>10.1f} +{span['duration_ms']:>10.1f} ms  {span_label(span):<36} {span_extras(span)}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Print the slowest bot update traces")
+    parser.add_argument("files", nargs="*", help="trace files (default: $TRACE_FILE and its rotations)")
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--min-ms", type=float, default=0)
+    parser.add_argument("--kind", help="update kind, e.g. message or callback_query")
+    parser.add_argument("--handler", help="only traces that ran this handler")
+    parser.add_argument("--user", type=int, help="only traces of this user id")
+    args = parser.parse_args()
+
+    traces = [trace for trace in load_traces(args.files or default_files()) if matches(trace, args)]
+    if not traces:
+        print("no traces found")
+        return
+    durations = [trace["duration_ms"] for trace in traces]
+    print(
+        f"{len(traces)} traces: p50 {percentile(durations, 0.5):.1f} ms, p95 {percentile(durations, 0.95):.1f} ms, "
+        f"max {max(durations):.1f} ms"
+    )
+    print_breakdown(traces)
+    print()
+    for rank, trace in enumerate(sorted(traces, key=lambda trace: -trace["duration_ms"])[:args.top], 1):
+        print_trace(rank, trace)
+        print()
+
+
+if __name__ == "__main__":
+    main_cli()